@@ -158,6 +158,9 @@ def main():
         frames_attempted = 0
         last_progress_update = 0
         last_flush_time = recording_start
+        # Each frame is written out before the next read, so a single buffer can be
+        # decoded into over and over instead of allocating a new frame per read
+        frame_buf = None
 
         print("🔴 Recording in progress (cloud mode)...")
 
@@ -174,15 +177,16 @@ def main():
             if current_time - last_flush_time > 2.0:  # Every 2 seconds
                 # Quick mini-flush (just 2-3 frames) to stay current
                 for _ in range(3):
-                    cap.read()
+                    cap.grab()  # Skip the frame without converting/copying it out
                 last_flush_time = current_time
                 logger.debug(f"Buffer mini-flush at {elapsed:.1f}s")
 
             frames_attempted += 1
 
             # Try to read a frame
-            ret, frame = cap.read()
+            ret, frame = cap.read(frame_buf)
             if ret and frame is not None:
+                frame_buf = frame
                 # Write frame to video
                 out.write(frame)
                 frames_written += 1
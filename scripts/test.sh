@@ -13,11 +13,12 @@ fi
 
 # Install test dependencies
 echo "📦 Installing test dependencies..."
-pip install pytest pytest-cov
+pip install pytest pytest-cov pytest-xdist
 
-# Run unit tests (no hardware required)
+# Run unit tests (no hardware required); the stream tests mostly wait on threads
+# and the video processor tests are CPU-bound, so each test class gets its own worker
 echo "🔬 Running unit tests..."
-python -m pytest tests/unit/ -v
+python -m pytest tests/unit/ -v -n 2 --dist loadscope
 
 # Ask if user wants to run integration tests
 echo ""
@@ -28,7 +28,8 @@ class Settings:
             'stream': {
                 'resolution': 'HD',  # HD, FHD, 4K
                 'fps': 15,
-                'timeout': 30
+                'timeout': 30,
+                'backend': os.getenv('REOLINK_CAPTURE_BACKEND', 'ffmpeg')  # ffmpeg, gstreamer
             },
             'processing': {
                 'save_frames': False,
@@ -38,7 +39,8 @@ class Settings:
                     'enabled': True,
                     'format': 'mp4',
                     'fps': 30,
-                    'quality': 'high'
+                    'quality': 'high',
+                    'encoder': os.getenv('CAPRID_SEGMENT_ENCODER', 'opencv')  # opencv, pyav
                 }
             }
         }
\ No newline at end of file
@@ -2,23 +2,54 @@ import sys
 import os
 import time
 from datetime import datetime, timedelta
-from processing.rolling_buffer import RollingBuffer
-import subprocess
+from google.api_core.exceptions import GoogleAPIError
+from google.api_core.retry import Retry, if_transient_error
+from google.cloud import storage
+from google.cloud.storage import transfer_manager
+from processing.rolling_buffer import RollingBuffer, _parse_segment_ts
 
 rolling_buffer = RollingBuffer()
 max_duration = rolling_buffer.max_seconds
+upload_workers = int(os.environ.get('GCS_UPLOAD_WORKERS', 8))
+
+# Uploads are idempotent overwrites, so transient failures are safe to retry
+_upload_retry = Retry(predicate=if_transient_error, timeout=120)
+# CRC32C (hardware-accelerated via google-crc32c) is the only integrity check; no MD5 pass
+_upload_kwargs = {"if_generation_match": None, "timeout": 60, "retry": _upload_retry, "checksum": "crc32c"}
+
+# Created on first upload; the auth handshake is a fixed per-process cost
+_gcs_client = None
+
+def _get_gcs_client():
+    global _gcs_client
+    if _gcs_client is None:
+        _gcs_client = storage.Client()
+    return _gcs_client
+
+def _new_blob(bucket, destination_blob_name):
+    blob = bucket.blob(destination_blob_name)
+    blob.chunk_size = None  # Small clips go up in one shot, no resumable session
+    return blob
 
 def upload_to_gcs(local_path, bucket_name, destination_blob_name):
-    """Upload a file to Google Cloud Storage using gcloud CLI"""
-    gcs_uri = f"gs://{bucket_name}/{destination_blob_name}"
-    result = subprocess.run(
-        ["gcloud", "storage", "cp", local_path, gcs_uri],
-        capture_output=True, text=True
+    """Upload a file to Google Cloud Storage in a single request"""
+    blob = _new_blob(_get_gcs_client().bucket(bucket_name), destination_blob_name)
+    blob.upload_from_filename(local_path, **_upload_kwargs)
+    return f"gs://{bucket_name}/{destination_blob_name}"
+
+def upload_many_to_gcs(uploads, bucket_name, max_workers=None):
+    """Upload (local_path, destination_blob_name) pairs concurrently; returns their gs:// URIs"""
+    bucket = _get_gcs_client().bucket(bucket_name)
+    file_blob_pairs = [(local_path, _new_blob(bucket, blob_name)) for local_path, blob_name in uploads]
+    # Uploads are network-bound, so threads are enough and avoid pickling the client
+    transfer_manager.upload_many(
+        file_blob_pairs,
+        upload_kwargs=_upload_kwargs,
+        raise_exception=True,
+        worker_type=transfer_manager.THREAD,
+        max_workers=max_workers or upload_workers,
     )
-    if result.returncode != 0:
-        print(f"gcloud upload failed: {result.stderr}")
-        sys.exit(2)
-    return gcs_uri
+    return [f"gs://{bucket_name}/{blob_name}" for _, blob_name in uploads]
 
 def usage():
     print("Usage: python scripts/extract_clip.py <center_time:YYYY-MM-DDTHH:MM:SS> [duration_in_seconds]")
@@ -46,16 +77,14 @@ def wait_for_future_segments(needed_end_time, timeout=10):
         if (datetime.now() - start_wait).total_seconds() > timeout:
             print("Timeout waiting for future segments")
             return False
-        # Check if we have segments up to the needed time
-        segment_tuples = [(
-            datetime.strptime(filename[len("segment_"):-len(".mp4")], "%Y%m%d_%H%M%S"),
-            os.path.join(rolling_buffer.buffer_dir, filename)
-        ) for filename in rolling_buffer._list_segments()]
-        if segment_tuples:
-            latest_segment = max(t[0] for t in segment_tuples)
-            if latest_segment >= needed_end_time:
-                return True
-        time.sleep(0.5)
+        # Check if we have segments up to the needed time. Names sort chronologically,
+        # so only the greatest one needs parsing.
+        latest_name = max(rolling_buffer._iter_segments(), default=None)
+        if latest_name and _parse_segment_ts(latest_name) >= needed_end_time:
+            return True
+        # Sleep long while the target is far off, then poll quickly near the deadline
+        remaining = (needed_end_time - datetime.now()).total_seconds()
+        time.sleep(max(0.05, min(0.5, remaining * 0.5)))
     return False
 
 if __name__ == "__main__":
@@ -81,14 +110,12 @@ if __name__ == "__main__":
             print("Failed to get future segments")
             sys.exit(1)
 
-    # Gather all available segment start times
+    # Gather all available segment start times once; the listing is already sorted
     segment_tuples = [
-        (datetime.strptime(filename[len("segment_"):-len(".mp4")], "%Y%m%d_%H%M%S"),
+        (_parse_segment_ts(filename),
          os.path.join(rolling_buffer.buffer_dir, filename))
         for filename in rolling_buffer._list_segments()
-        if filename.startswith("segment_") and filename.endswith(".mp4")
     ]
-    segment_tuples.sort()
 
     # Check if we have segments covering our time window
     if not segment_tuples:
@@ -96,30 +123,25 @@ if __name__ == "__main__":
         print_buffer_window()
         sys.exit(2)
 
-    # Find needed segments
-    needed_segments = [
-        (segment_start_time, segment_path) for segment_start_time, segment_path in segment_tuples
-        if segment_start_time + timedelta(seconds=rolling_buffer.segment_duration) > start_time and segment_start_time < end_time
-    ]
-    
-    if not needed_segments:
-        print_buffer_window()
-        print_available_segments(segment_tuples)
-        print("Error: Requested time window is not in buffer window.")
-        sys.exit(2)
-    
-    needed_segments.sort()
-    first_needed_start = needed_segments[0][0]
-    last_needed_end = needed_segments[-1][0] + timedelta(seconds=rolling_buffer.segment_duration)
-    
-    if first_needed_start > start_time or last_needed_end < end_time:
+    # Segments are cut on keyframes, so their lengths vary; the buffer works out
+    # which ones cover the window from their neighbours' start times
+    try:
+        needed_segments = rolling_buffer.select_segments(start_time, end_time, segment_tuples)
+    except RuntimeError as e:
         print_buffer_window()
         print_available_segments(segment_tuples)
-        print("Error: Requested time window is not fully covered by buffer window.")
+        print(f"Error: {e}")
         sys.exit(2)
     output_path = f"clip_{center_time.strftime('%Y%m%d_%H%M%S')}_{duration_seconds}s.mp4"
-    result_path = rolling_buffer.extract_clip(start_time, duration=duration_seconds, output_path=output_path)
-    
+    try:
+        result_path = rolling_buffer.extract_clip(
+            start_time, duration=duration_seconds, output_path=output_path, segments=needed_segments
+        )
+    except Exception as e:
+        # PyAV raises its own errors for segments it can't remux, as well as RuntimeError
+        print(f"Error: Clip extraction failed: {e}")
+        sys.exit(2)
+
     if not os.path.exists(result_path) or os.path.getsize(result_path) < 1024:
         print("Error: Extracted clip is empty or too small. Likely requested time is not in buffer window.")
         sys.exit(2)
@@ -127,8 +149,14 @@ if __name__ == "__main__":
     print(f"Clip extracted to {result_path}")
     bucket_name = os.environ.get('GCS_BUCKET_NAME', 'caprid-videos-demo')
     project = os.environ.get('GOOGLE_CLOUD_PROJECT', 'pickle-devops-dev')
-    os.environ['GOOGLE_CLOUD_PROJECT'] = project  # Ensure gcloud uses the right project
+    os.environ['GOOGLE_CLOUD_PROJECT'] = project  # Ensure the storage client uses the right project
     
     print(f"Using GCS bucket: {bucket_name} in project: {project}")
-    gcs_url = upload_to_gcs(result_path, bucket_name, f"buffer-captures/{os.path.basename(result_path)}")
-    print(f"✅ Uploaded to {gcs_url}")
\ No newline at end of file
+    uploads = [(result_path, f"buffer-captures/{os.path.basename(result_path)}")]
+    try:
+        gcs_urls = upload_many_to_gcs(uploads, bucket_name)
+    except (GoogleAPIError, OSError) as e:
+        print(f"GCS upload failed: {e}")
+        sys.exit(2)
+    for gcs_url in gcs_urls:
+        print(f"✅ Uploaded to {gcs_url}")
\ No newline at end of file
@@ -1,8 +1,11 @@
 import logging
+import itertools
+import os
 import time
 import signal
 import sys
 from datetime import datetime, timedelta
+import cv2
 from config.settings import Settings
 from stream.reolink_client import ReolinkClient
 from stream.stream_handler import StreamHandler
@@ -11,6 +14,9 @@ from processing.video_processor import VideoProcessor
 # Global flag for graceful shutdown
 running = True
 
+# Frames seen by frame_callback; a C-level counter keeps the per-frame cost minimal
+_frame_counter = itertools.count(1)
+
 def setup_logging():
     logging.basicConfig(
         level=logging.INFO,
@@ -36,15 +42,12 @@ def frame_callback(frame):
         return False
     
     # Optional: Print frame info periodically
-    if hasattr(frame_callback, 'frame_count'):
-        frame_callback.frame_count += 1
-    else:
-        frame_callback.frame_count = 1
+    frame_count = next(_frame_counter)
     
     # Print status every 300 frames (about 10 seconds at 30fps)
-    if frame_callback.frame_count % 300 == 0:
-        timestamp = datetime.now().strftime('%H:%M:%S')
-        print(f"📹 [{timestamp}] Processed {frame_callback.frame_count} frames, Frame size: {frame.shape}")
+    if frame_count % 300 == 0:
+        timestamp = time.strftime('%H:%M:%S')
+        print(f"📹 [{timestamp}] Processed {frame_count} frames, Frame size: {frame.shape}")
     
     return True
 
@@ -58,6 +61,11 @@ def main():
     setup_logging()
     logger = logging.getLogger(__name__)
     
+    # OpenCV's own worker pool would compete with the capture, callback and writer
+    # threads for cores; parallelism stays at that level unless CAPRID_CV_THREADS says
+    # otherwise. The setting is process-wide, so it belongs here and not in a library class.
+    cv2.setNumThreads(int(os.environ.get("CAPRID_CV_THREADS", 1)))
+    
     # Load configuration
     settings = Settings()
     config = settings.config
@@ -76,13 +84,18 @@ def main():
         return 1
     
     # Get video stream
-    cap = client.get_video_stream(config['reolink']['channel'])
+    cap = None
+    if config.get('stream', {}).get('backend') == 'gstreamer':
+        cap = client.get_gstreamer_stream(config['reolink']['channel'])
+    if not cap:
+        cap = client.get_video_stream(config['reolink']['channel'])
     if not cap:
         logger.error("Failed to get video stream")
         return 1
     
     # Initialize stream handler with buffer for historical recording
-    stream_handler = StreamHandler(cap, buffer_seconds=60)
+    encoder = config.get('processing', {}).get('segment_recording', {}).get('encoder', 'opencv')
+    stream_handler = StreamHandler(cap, buffer_seconds=60, encoder=encoder)
     processor = VideoProcessor()
     
     try:
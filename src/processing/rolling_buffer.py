@@ -1,43 +1,191 @@
 import os
-import cv2
 import time
+import bisect
+import functools
+import tempfile
+import threading
 import subprocess
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime, timedelta
+from fractions import Fraction
 from stream.reolink_client import ReolinkClient
 from config.settings import Settings
 
+try:
+    import av
+except ImportError:  # Without PyAV, recording and clip extraction use the ffmpeg CLI instead
+    av = None
+
+@functools.lru_cache(maxsize=4096)
+def _parse_segment_ts(fname):
+    """Parse the start time out of a 'segment_YYYYMMDD_HHMMSS.mp4' filename."""
+    # Fixed-width slicing is much cheaper than strptime, and names repeat across polls
+    return datetime(int(fname[8:12]), int(fname[12:14]), int(fname[14:16]),
+                    int(fname[17:19]), int(fname[19:21]), int(fname[21:23]))
+
+def _probe_duration(path):
+    """Return a segment file's duration in seconds, or 0 if it can't be read yet."""
+    # The muxer writes an MP4's index when it closes the file, so the segment still
+    # being recorded has no readable duration (and no readable frames) until then
+    try:
+        if av is not None:
+            with av.open(path) as container:
+                return (container.duration or 0) / av.time_base
+        result = subprocess.run(
+            ["ffprobe", "-v", "error", "-show_entries", "format=duration", "-of", "csv=p=0", path],
+            stdout=subprocess.PIPE, stderr=subprocess.DEVNULL, text=True
+        )
+        return float(result.stdout.strip() or 0)
+    except Exception:
+        return 0
+
 class RollingBuffer:
+    # Seconds to wait before reopening the camera stream after the recorder stops
+    restart_delay = 2
+
     def __init__(self, buffer_dir="/home/pickle/src/pickle/caprid/rolling_buffer", segment_duration=1, buffer_duration=900):
         """
         Args:
             buffer_dir (str): Directory where segments are stored.
-            segment_duration (int): Duration of each segment in seconds.
+            segment_duration (int): Target duration of each segment in seconds. Segments
+                are stream-copied and can only be cut on a keyframe, so each one runs to
+                the first keyframe at or after this (one camera GOP when it is longer).
             buffer_duration (int): Total buffer duration in seconds.
         """
-        self.buffer_dir = buffer_dir
+        # Resolved once so segment paths built from it are already absolute
+        self.buffer_dir = os.path.abspath(buffer_dir)
         self.segment_duration = segment_duration
         self.buffer_duration = buffer_duration
         os.makedirs(self.buffer_dir, exist_ok=True)
+        # (directory mtime_ns, sorted segment filenames); swapped as one tuple so a
+        # concurrent reader never pairs a new mtime with a stale listing
+        self._cache = (-1, [])
+        # (listing, start times, end times, paths) parsed from the cached listing above,
+        # so repeated extracts bisect without re-parsing every filename
+        self._index = (None, [], [], [])
+        # Durations of closed segments by path; a closed file never changes, so each
+        # is probed once and dropped again when the segment is removed
+        self._durations = {}
+        # Worker threads are only started once there is something to remove
+        self._remove_pool = ThreadPoolExecutor(max_workers=4, thread_name_prefix="segment-cleanup")
 
     @property
     def max_seconds(self):
         return self.buffer_duration
 
+    def _iter_segments(self):
+        """Yield segment filenames straight from the directory, in no particular order."""
+        with os.scandir(self.buffer_dir) as entries:
+            for entry in entries:
+                name = entry.name
+                if name.startswith("segment_") and name.endswith(".mp4"):
+                    yield name
+
     def _list_segments(self):
-        """Return a sorted list of segment filenames."""
-        files = [f for f in os.listdir(self.buffer_dir) if f.startswith("segment_") and f.endswith(".mp4")]
-        files.sort()
+        """Return a sorted list of segment filenames. The list is shared; don't mutate it."""
+        # Adding or removing a segment bumps the directory mtime, so an unchanged
+        # mtime means the cached listing is still current
+        mtime = os.stat(self.buffer_dir).st_mtime_ns
+        cached_mtime, cached_files = self._cache
+        if mtime == cached_mtime:
+            return cached_files
+        files = sorted(self._iter_segments())
+        self._cache = (mtime, files)
         return files
 
+    def _segment_index(self):
+        """Return parallel sorted lists (start times, end times, paths) for the current listing."""
+        files = self._list_segments()
+        cached_files, starts, ends, paths = self._index
+        if cached_files is files:
+            return starts, ends, paths
+        starts, paths = [], []
+        for fname in files:
+            try:
+                starts.append(_parse_segment_ts(fname))
+            except ValueError:
+                continue
+            paths.append(os.path.join(self.buffer_dir, fname))
+        starts, ends = self._segment_timeline(starts, paths)
+        self._index = (files, starts, ends, paths)
+        return starts, ends, paths
+
+    def _closed_segment_duration(self, path):
+        """Return the duration of a segment the muxer has finished writing."""
+        duration = self._durations.get(path)
+        if duration is None:
+            duration = _probe_duration(path)
+            if duration:  # Not cached while unreadable, so a later call retries
+                self._durations[path] = duration
+        return duration
+
+    def _segment_timeline(self, name_starts, paths):
+        """
+        Return (start times, end times) for segments with the given filename start times.
+
+        Stream-copied segments are cut on the camera's keyframes, so they neither last
+        segment_duration nor start on the whole second their filename records. Each
+        segment's end is its start plus its real duration, and a segment that continues
+        the previous one (its filename second matches where that one ended) starts
+        exactly there. The newest segment is still being written, so its end is None.
+        """
+        starts, ends = [], []
+        one_second = timedelta(seconds=1)
+        for i, (start, path) in enumerate(zip(name_starts, paths)):
+            # Across a reconnect the previous end falls outside this second, and the
+            # filename is the best estimate there is
+            if ends and start <= ends[-1] < start + one_second:
+                start = ends[-1]
+            starts.append(start)
+            if i == len(paths) - 1:
+                ends.append(None)
+            else:
+                ends.append(start + timedelta(seconds=self._closed_segment_duration(path)))
+        return starts, ends
+
     def get_segment_times(self):
         """Return a list of (start_time: datetime, filename) tuples for all segments."""
         segment_files = self._list_segments()
-        return [
-            (datetime.strptime(f[len("segment_"):-len(".mp4")], "%Y%m%d_%H%M%S"), f)
-            for f in segment_files
-        ]
+        return [(_parse_segment_ts(f), f) for f in segment_files]
+
+    def select_segments(self, start_time, end_time, segments=None):
+        """
+        Return the (start_time, path) run of segments covering [start_time, end_time).
+
+        Args:
+            start_time (datetime): Start of the window.
+            end_time (datetime): End of the window.
+            segments (list, optional): Sorted (start_time, path) tuples to pick from
+                instead of the current buffer listing.
 
-    def extract_clip(self, start_time, duration, output_path):
+        Raises:
+            RuntimeError: If the window isn't in the buffer, or only partly is.
+        """
+        if segments is None:
+            seg_starts, seg_ends, seg_paths = self._segment_index()
+        else:
+            seg_paths = [seg_path for _, seg_path in segments]
+            seg_starts, seg_ends = self._segment_timeline(
+                [seg_start for seg_start, _ in segments], seg_paths
+            )
+
+        # Segments overlapping the requested window are a contiguous run of the sorted
+        # list, from the last one starting at or before start_time
+        lo = bisect.bisect_right(seg_starts, start_time) - 1
+        hi = bisect.bisect_left(seg_starts, end_time)
+        if hi == 0:
+            raise RuntimeError("Requested time is not in buffer window.")
+        last_end = seg_ends[hi - 1]
+        if last_end is None:
+            # Only the newest segment's length has to be read from the file itself
+            last_end = seg_starts[hi - 1] + timedelta(seconds=_probe_duration(seg_paths[hi - 1]))
+        if last_end <= start_time:
+            raise RuntimeError("Requested time is not in buffer window.")
+        if lo < 0 or last_end < end_time:
+            raise RuntimeError("Requested time window is not fully covered by buffer window.")
+        return list(zip(seg_starts[lo:hi], seg_paths[lo:hi]))
+
+    def extract_clip(self, start_time, duration, output_path, segments=None, snap_to_keyframe=False):
         """
         Extract a clip from the buffer.
 
@@ -45,76 +193,137 @@ class RollingBuffer:
             start_time (datetime): Start time of the clip.
             duration (int): Duration of the clip in seconds.
             output_path (str): Path to save the extracted clip.
+            segments (list, optional): Sorted (start_time, path) tuples to pick from.
+                Callers that already scanned the buffer pass them to avoid a rescan.
+            snap_to_keyframe (bool): Start the clip at the beginning of the segment
+                containing start_time (lengthening it to still reach the requested end).
+                Segments start on keyframes, so the cut needs no seek at all.
 
         Returns:
             str: Path to the extracted clip.
+
+        Clips are stream-copied, so without snapping they start at the last keyframe
+        at or before start_time rather than exactly on it.
         """
-        # Find all segments that overlap with the requested window
-        end_time = start_time + timedelta(seconds=duration)
-        needed_segments = []
-        for fname in self._list_segments():
-            ts_str = fname[len("segment_"):-len(".mp4")]
-            try:
-                seg_start = datetime.strptime(ts_str, "%Y%m%d_%H%M%S")
-                seg_end = seg_start + timedelta(seconds=self.segment_duration)
-                # If segment overlaps with requested window, include it
-                if seg_end > start_time and seg_start < end_time:
-                    needed_segments.append(os.path.join(self.buffer_dir, fname))
-            except Exception:
-                continue
+        needed_segments = self.select_segments(
+            start_time, start_time + timedelta(seconds=duration), segments
+        )
+        if snap_to_keyframe:
+            duration += (start_time - needed_segments[0][0]).total_seconds()
+            start_time = needed_segments[0][0]
+        start_offset = (start_time - needed_segments[0][0]).total_seconds()
 
-        if not needed_segments or (needed_segments[0] > end_time.strftime("%Y%m%d_%H%M%S")):
-            raise RuntimeError("Requested time is not in buffer window.")
+        if av is not None:
+            self._remux_segments(needed_segments, start_time, duration, output_path)
+            return output_path
 
-        # Write ffmpeg concat file
-        concat_list_path = os.path.join(self.buffer_dir, "segments_to_concat.txt")
-        with open(concat_list_path, "w") as f:
-            for seg in needed_segments:
-                f.write(f"file '{os.path.abspath(seg)}'\n")
+        # Write ffmpeg concat file. It goes in the temp dir, not buffer_dir, so it
+        # doesn't invalidate the listing cache and concurrent extracts don't collide.
+        with tempfile.NamedTemporaryFile("w", suffix=".txt", prefix="concat_", delete=False) as f:
+            f.writelines(f"file '{seg_path}'\n" for _, seg_path in needed_segments)
+            concat_list_path = f.name
 
-        # Use ffmpeg to concatenate
-        cmd = [
-            "ffmpeg", "-y", "-f", "concat", "-safe", "0",
+        # Use ffmpeg to concatenate. -ss before -i seeks the input to the nearest
+        # keyframe instead of demuxing and discarding everything up to the offset.
+        cmd = ["ffmpeg", "-y", "-loglevel", "error", "-nostats"]
+        if start_offset:
+            cmd += ["-ss", str(start_offset)]
+        cmd += [
+            "-f", "concat", "-safe", "0",
             "-i", concat_list_path,
-            "-ss", str((start_time - datetime.strptime(
-                os.path.basename(needed_segments[0])[8:-4], "%Y%m%d_%H%M%S"
-            )).total_seconds()),
             "-t", str(duration),
-            "-c", "copy", output_path
+            "-c", "copy", "-avoid_negative_ts", "make_zero", output_path
         ]
-        result = subprocess.run(cmd, capture_output=True)
+        try:
+            # Only error output is captured; ffmpeg's progress chatter is silenced at the source
+            result = subprocess.run(cmd, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE)
+        finally:
+            os.remove(concat_list_path)
         if result.returncode != 0:
             raise RuntimeError(f"ffmpeg failed: {result.stderr.decode()}")
         return output_path
 
+    def _remux_segments(self, segments, start_time, duration, output_path):
+        """
+        Stream-copy the packets covering [start_time, start_time + duration) into
+        output_path in-process, without re-encoding.
+
+        The clip starts at the last keyframe at or before start_time so that it
+        decodes cleanly, the same as ffmpeg's -c copy.
+        """
+        clip_start = Fraction((start_time - segments[0][0]).total_seconds())
+        out_stream = None
+        pending = []  # Packets since the last keyframe before the clip start
+        base = None   # Offset (s) of the first muxed packet; becomes t=0 in the output
+        seg_offset = Fraction(0)
+
+        with av.open(output_path, mode="w") as output:
+            for _, seg_path in segments:
+                # Segments restart their timestamps at zero and don't start on the whole
+                # second in their names, so each one is placed right after the last
+                # packet of the one before it
+                seg_end = 0  # End of the segment's last packet, in its time base
+                last_dts = None
+                with av.open(seg_path) as segment:
+                    in_stream = segment.streams.video[0]
+                    if out_stream is None:
+                        out_stream = output.add_stream_from_template(in_stream)
+                    time_base = in_stream.time_base
+                    for packet in segment.demux(in_stream):
+                        if packet.pts is None:  # Demuxer flush packet
+                            continue
+                        dts = packet.dts if packet.dts is not None else packet.pts
+                        seg_end = dts + (packet.duration or (dts - last_dts if last_dts is not None else 0))
+                        last_dts = dts
+                        t = packet.pts * time_base + seg_offset
+                        if t - clip_start >= duration:
+                            break
+                        dts_t = dts * time_base + seg_offset
+                        if base is None:
+                            if packet.is_keyframe and t <= clip_start:
+                                pending = []  # A later keyframe before the start supersedes earlier ones
+                            if not pending and not packet.is_keyframe:
+                                continue  # Output has to begin on a keyframe
+                            pending.append((packet, t, dts_t))
+                            if t < clip_start:
+                                continue
+                            base = pending[0][1]
+                        else:
+                            pending.append((packet, t, dts_t))
+                        for p, p_t, p_dts in pending:
+                            p.pts = round((p_t - base) / p.time_base)
+                            p.dts = round((p_dts - base) / p.time_base)
+                            p.stream = out_stream
+                            output.mux(p)
+                        pending = []
+                seg_offset += seg_end * time_base
+
+        if base is None:
+            raise RuntimeError("No keyframe found in the requested time window.")
+
     def _cleanup_old_segments(self):
         """Remove segments that are older than the buffer duration."""
-        segment_tuples = self.get_segment_times()
-        if not segment_tuples:
+        # Segment lengths follow the camera's GOP, so age decides rather than a file
+        # count. A segment is stale once the next one starts at or before the cutoff;
+        # with the index sorted oldest-first, those are a single prefix slice.
+        seg_starts, _, seg_paths = self._segment_index()
+        cutoff = datetime.now() - timedelta(seconds=self.buffer_duration)
+        stale = seg_paths[:max(bisect.bisect_right(seg_starts, cutoff) - 1, 0)]
+        if not stale:
             return
+        # Unlinks are blocking metadata syscalls that release the GIL, so a catch-up
+        # batch is spread over a few threads
+        list(self._remove_pool.map(self._remove_segment, stale))
 
-        # Sort by timestamp
-        segment_tuples.sort()  # This sorts by timestamp since it's the first element of each tuple
-        
-        # Calculate the total duration of segments
-        total_duration = 0
-        segments_to_keep = []
-        
-        # Work backwards from newest to oldest
-        for timestamp, filename in reversed(segment_tuples):
-            total_duration += self.segment_duration
-            if total_duration <= self.buffer_duration:
-                segments_to_keep.append(filename)
-            else:
-                # Remove this segment since it's outside our buffer window
-                try:
-                    full_path = os.path.join(self.buffer_dir, filename)
-                    os.remove(full_path)
-                except Exception as e:
-                    print(f"Error removing old segment {filename}: {e}")
+    def _remove_segment(self, path):
+        self._durations.pop(path, None)
+        try:
+            os.remove(path)
+        except Exception as e:
+            print(f"Error removing old segment {os.path.basename(path)}: {e}")
 
     def start_recording(self):
-        """Continuously records 1s segments from the Reolink stream."""
+        """Continuously records keyframe-aligned segments from the Reolink stream."""
         settings = Settings()
         config = settings.config
         client = ReolinkClient(
@@ -125,38 +334,90 @@ class RollingBuffer:
         )
         if not client.authenticate():
             raise RuntimeError("Failed to authenticate with camera")
-        cap = client.get_video_stream(config['reolink']['channel'])
-        if not cap:
-            raise RuntimeError("Failed to get video stream")
+        channel = config['reolink']['channel']
 
-        fps = int(cap.get(cv2.CAP_PROP_FPS)) or 15
-        width = int(cap.get(cv2.CAP_PROP_FRAME_WIDTH))
-        height = int(cap.get(cv2.CAP_PROP_FRAME_HEIGHT))
-
-        print(f"Rolling buffer started: {self.buffer_duration} sec, {self.segment_duration}s segments, {fps} FPS")
+        print(f"Rolling buffer started: {self.buffer_duration} sec, {self.segment_duration}s target segments, stream copy")
+        stop_cleanup = threading.Event()
+        cleaner = threading.Thread(target=self._cleanup_loop, args=(stop_cleanup,), daemon=True)
+        cleaner.start()
+        record = self._record_stream_copy if av is not None else self._record_with_ffmpeg
         try:
+            # RTSP sessions drop now and then; reopen the stream in place rather than
+            # exiting and paying for a service restart and re-authentication
             while True:
-                # Clean up old segments before recording a new one
-                self._cleanup_old_segments()
-                
-                start_time = datetime.now()
-                fname = os.path.join(self.buffer_dir, f"segment_{start_time.strftime('%Y%m%d_%H%M%S')}.mp4")
-                fourcc = cv2.VideoWriter_fourcc(*'mp4v')
-                out = cv2.VideoWriter(fname, fourcc, fps, (width, height))
-                frames_to_write = int(fps * self.segment_duration)
-                for _ in range(frames_to_write):
-                    ret, frame = cap.read()
-                    if not ret:
+                # The URLs are rebuilt on every attempt so a reconnect picks up a changed
+                # camera address, and each RTSP URL format is tried in turn
+                for fmt, stream_url in client.get_stream_urls(channel):
+                    newest = self._list_segments()[-1:]
+                    try:
+                        record(stream_url)
+                        error = "stream ended"
+                    except Exception as e:
+                        error = e
+                    if self._list_segments()[-1:] != newest:
+                        # The format delivered video, so the session dropped rather than failing to open
+                        client.remember_stream_format(channel, fmt)
+                        print(f"Camera stream lost ({error}), reconnecting in {self.restart_delay}s")
                         break
-                    out.write(frame)
-                out.release()
-                
-                # Sleep to align with real time
-                elapsed = (datetime.now() - start_time).total_seconds()
-                if elapsed < self.segment_duration:
-                    time.sleep(self.segment_duration - elapsed)
+                    print(f"RTSP URL format {fmt + 1} failed: {error}")
+                else:
+                    print(f"No RTSP URL format opened the stream, retrying in {self.restart_delay}s")
+                time.sleep(self.restart_delay)
+        finally:
+            stop_cleanup.set()
+
+    def _cleanup_loop(self, stop, interval=10):
+        """Prune old segments every `interval` seconds until stop is set."""
+        self._cleanup_old_segments()
+        while not stop.wait(interval):
+            self._cleanup_old_segments()
+
+    def _record_stream_copy(self, stream_url):
+        """
+        Copy the camera's encoded stream into segment files with the segment muxer.
+
+        A single muxer rolls the files over, so there is no per-segment writer setup,
+        and packets are copied as-is instead of being decoded and re-encoded. Without
+        re-encoding, a file can only end on a keyframe, so its length is
+        segment_duration rounded up to the camera's GOP. Readers work each segment's
+        start and end out from the real durations (see _segment_timeline) rather than
+        assuming them.
+        """
+        pattern = os.path.join(self.buffer_dir, "segment_%Y%m%d_%H%M%S.mp4")
+        segment_options = {
+            "segment_time": str(self.segment_duration),
+            "segment_format": "mp4",
+            "strftime": "1",
+            "reset_timestamps": "1",
+        }
+        with av.open(stream_url, options={"rtsp_transport": "tcp"}, timeout=10) as source:
+            in_stream = source.streams.video[0]
+            with av.open(pattern, mode="w", format="segment", options=segment_options) as output:
+                out_stream = output.add_stream_from_template(in_stream)
+                for packet in source.demux(in_stream):
+                    if packet.dts is None:  # Demuxer flush packet
+                        continue
+                    packet.stream = out_stream
+                    output.mux(packet)
+
+    def _record_with_ffmpeg(self, stream_url):
+        """Same as _record_stream_copy, but run by a long-lived ffmpeg process."""
+        cmd = [
+            "ffmpeg", "-loglevel", "error", "-nostats", "-rtsp_transport", "tcp", "-i", stream_url,
+            "-c", "copy", "-f", "segment", "-segment_format", "mp4",
+            "-segment_time", str(self.segment_duration),
+            "-reset_timestamps", "1", "-strftime", "1",
+            os.path.join(self.buffer_dir, "segment_%Y%m%d_%H%M%S.mp4")
+        ]
+        proc = subprocess.Popen(cmd, stdin=subprocess.DEVNULL)
+        try:
+            returncode = proc.wait()
         finally:
-            cap.release()
+            if proc.poll() is None:
+                proc.terminate()
+                proc.wait()
+        if returncode != 0:
+            raise RuntimeError(f"ffmpeg recorder exited with code {returncode}")
 
 if __name__ == "__main__":
     RollingBuffer().start_recording()
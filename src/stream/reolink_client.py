@@ -1,18 +1,58 @@
 import requests
 import cv2
+import os
+import json
+import time
+import socket
+import functools
+import threading
 import numpy as np
 from typing import Optional, Generator
 import logging
 import urllib3
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from urllib.parse import quote
+from requests.adapters import HTTPAdapter
 from requests.auth import HTTPBasicAuth
 
 # Disable SSL warnings for self-signed certificates
 urllib3.disable_warnings(urllib3.exceptions.InsecureRequestWarning)
 
+# Have OpenCV's FFmpeg backend pull RTSP over TCP (more reliable than UDP) unless overridden
+os.environ.setdefault("OPENCV_FFMPEG_CAPTURE_OPTIONS", "rtsp_transport;tcp")
+
+# Known working RTSP URL patterns for your camera type; ch is the 1-based channel
+RTSP_URL_TEMPLATES = [
+    "rtsp://{user}:{pw}@{host}:554/h264Preview_{ch:02d}_main",
+    "rtsp://{user}:{pw}@{host}:554/h264Preview_{ch:02d}_sub",
+    "rtsp://{user}:{pw}@{host}:554/Preview_{ch:02d}_main",
+    "rtsp://{user}:{pw}@{host}:554/cam/realmonitor?channel={ch}&subtype=0",
+    "rtsp://{user}:{pw}@{host}:554/live",
+    "rtsp://{user}:{pw}@{host}:554/stream1",
+]
+
+@functools.lru_cache(maxsize=None)
+def _opencv_has_gstreamer() -> bool:
+    """Whether this OpenCV build includes the GStreamer capture backend"""
+    return any(line.strip().startswith("GStreamer:") and "YES" in line
+               for line in cv2.getBuildInformation().splitlines())
+
 class ReolinkClient:
     """Client for connecting to Reolink cameras and handling video streams"""
     
-    def __init__(self, host: str, username: str, password: str, port: int = 80):
+    # Seconds a resolved camera address is reused before looking it up again
+    RESOLVE_TTL = 300
+    
+    # Seconds a quick probe waits: the TCP reachability check, and the whole request
+    # when authenticate() retries the cached endpoint
+    PROBE_TIMEOUT = 0.5
+    
+    # Auth methods authenticate() may use, cheapest first; restrict per instance or
+    # subclass, e.g. ("rtsp",) for a camera whose web interface is disabled
+    auth_strategies = ("basic", "api", "rtsp")
+    
+    def __init__(self, host: str, username: str, password: str, port: int = 80,
+                 cache_dir: Optional[str] = "~/.cache/caprid"):
         self.host = host
         self.username = username
         self.password = password
@@ -20,74 +60,223 @@ class ReolinkClient:
         self.token = None
         self.auth_method = None
         self.logger = logging.getLogger(__name__)
+        self._resolved_host = None
+        self._resolved_at = 0.0
+        self._reachable_cache = {}
+        
+        # Credentials are percent-encoded so characters like '@' or ':' in a password
+        # don't break the URL; only the host and channel vary per open
+        user, pw = quote(username, safe=""), quote(password, safe="")
+        self._rtsp_userinfo = f"{user}:{pw}"
+        self._rtsp_templates = [t.replace("{user}", user).replace("{pw}", pw) for t in RTSP_URL_TEMPLATES]
+        
+        # One pooled session so repeated auth attempts reuse the TCP/TLS connection
+        self._session = requests.Session()
+        self._session.mount("http://", HTTPAdapter(pool_connections=4, pool_maxsize=8, max_retries=0))
+        self._session.mount("https://", HTTPAdapter(pool_connections=4, pool_maxsize=8, max_retries=0))
+        self._session.verify = False
+        
+        # Remembers which method worked last time so reconnects skip the full probe
+        self._cache_path = (os.path.join(os.path.expanduser(cache_dir), f"reolink_{host}.json")
+                            if cache_dir else None)
+        self._cache_lock = threading.Lock()
+        
+        # Index into RTSP_URL_TEMPLATES that last opened each channel, tried first next time
+        try:
+            self._working_stream_idx = {int(ch): int(i) for ch, i in
+                                        self._read_cache().get("stream_url_index", {}).items()}
+        except (AttributeError, TypeError, ValueError):
+            self._working_stream_idx = {}
         
     def authenticate(self) -> bool:
-        """Authenticate with the Reolink camera using the best available method"""
+        """Authenticate with the Reolink camera using the first method that succeeds"""
         
-        # Method 1: Try HTTP Basic Auth (works with your camera!)
-        if self._try_basic_auth():
-            return True
-            
-        # Method 2: Try RTSP direct (fallback, also works with your camera!)
-        if self._try_rtsp_auth():
-            return True
-            
-        # Method 3: Try original API method (if others fail)
-        if self._try_api_auth():
+        self._reachable_cache = {}
+        
+        # A reconnect almost always succeeds the same way as last time, so try that alone first.
+        # It is only a shortcut, so a stale endpoint gets the short timeout rather than
+        # holding up the full probe below for the normal request timeout.
+        cached = self._load_cached_endpoint()
+        if cached:
+            method, args = cached
+            options = {} if method == "rtsp" else {"timeout": self.PROBE_TIMEOUT}
+            result = self._auth_probes()[method](*args, **options)
+            if result:
+                self._apply_auth(method, args, result)
+                return True
+            self._forget_cached_endpoint()
+        
+        candidates = self._auth_candidates()
+        # Opening an RTSP stream takes one of the camera's few session slots and can't be
+        # called off once started, so it is only tried after every HTTP probe has failed
+        http = [candidate for candidate in candidates if candidate[0] != "rtsp"]
+        rtsp = [candidate for candidate in candidates if candidate[0] == "rtsp"]
+        success = self._probe_concurrently(http) if http else None
+        for method, probe, args in rtsp:
+            if success:
+                break
+            result = probe(*args)
+            if result:
+                success = (method, args, result)
+        
+        if success:
+            # Probes only report back; client state is updated here, on one thread
+            method, args, result = success
+            self._apply_auth(method, args, result)
+            self._save_cached_endpoint(method, args)
             return True
         
         self.logger.error("All authentication methods failed")
         return False
     
-    def _try_basic_auth(self) -> bool:
-        """Try HTTP Basic Authentication"""
-        self.logger.info("Trying HTTP Basic Authentication...")
-        
-        # Test different ports for Basic Auth
-        test_ports = [self.port, 80, 443]
-        protocols = ['https', 'http'] if self.port == 443 else ['http', 'https']
-        
-        for protocol in protocols:
-            for port in test_ports:
-                try:
-                    url = f"{protocol}://{self.host}:{port}/"
-                    self.logger.info(f"Testing Basic Auth: {url}")
-                    
-                    response = requests.get(url, auth=HTTPBasicAuth(self.username, self.password), 
-                                          timeout=10, verify=False)
-                    
-                    if response.status_code == 200:
-                        self.logger.info(f"✅ HTTP Basic Auth successful via {protocol}:{port}")
-                        self.auth_method = "basic"
-                        self.port = port  # Update port if different
-                        return True
-                    elif response.status_code == 401:
-                        self.logger.warning(f"❌ Basic Auth failed: Invalid credentials")
-                    else:
-                        self.logger.debug(f"Basic Auth {protocol}:{port} returned: {response.status_code}")
-                        
-                except Exception as e:
-                    self.logger.debug(f"Basic Auth {protocol}:{port} error: {e}")
+    def _probe_concurrently(self, candidates: list) -> Optional[tuple]:
+        """Run (auth_method, probe, args) candidates at once; return the first (auth_method, args, result) to succeed"""
+        # All at once, so a camera that only answers the last one costs a single timeout
+        # rather than the sum of all of them
+        executor = ThreadPoolExecutor(max_workers=len(candidates), thread_name_prefix="reolink-auth")
+        futures = {executor.submit(probe, *args): (method, args) for method, probe, args in candidates}
+        try:
+            for future in as_completed(futures):
+                result = future.result()
+                if result:
+                    method, args = futures[future]
+                    return method, args, result
+        finally:
+            # Every probe got its own worker, so none is left queued to cancel; those still
+            # in flight are bounded HTTP requests that finish in the background and are ignored
+            executor.shutdown(wait=False)
+        return None
+    
+    def _apply_auth(self, method: str, args: tuple, result):
+        """Record a successful probe on the client"""
+        self.auth_method = method
+        if method == "basic":
+            self.port = args[1]  # Update port if different
+        elif method == "api":
+            self.token = result
+    
+    def _auth_probes(self) -> dict:
+        return {"basic": self._try_basic_auth, "rtsp": self._try_rtsp_auth, "api": self._try_api_auth}
+    
+    def _load_cached_endpoint(self) -> Optional[tuple]:
+        """Return the (auth_method, args) that worked last time, if any"""
+        entry = self._read_cache()
+        try:
+            method, args = entry["auth_method"], tuple(entry["args"])
+        except (KeyError, TypeError):
+            return None
+        return (method, args) if method in self.auth_strategies else None
+    
+    def _save_cached_endpoint(self, method: str, args: tuple):
+        self._update_cache(auth_method=method, args=list(args))
+    
+    def _forget_cached_endpoint(self):
+        self._update_cache(auth_method=None, args=None)
+    
+    def _read_cache(self) -> dict:
+        """Return the per-host cache file contents, or {} if there is none"""
+        if not self._cache_path:
+            return {}
+        try:
+            with open(self._cache_path) as f:
+                entry = json.load(f)
+        except (OSError, ValueError):
+            return {}
+        return entry if isinstance(entry, dict) else {}
+    
+    def _update_cache(self, **entries):
+        """Merge entries into the per-host cache file; a value of None removes the key"""
+        if not self._cache_path:
+            return
+        # The RTSP probe records its stream format from an auth worker thread
+        with self._cache_lock:
+            entry = self._read_cache()
+            for key, value in entries.items():
+                if value is None:
+                    entry.pop(key, None)
+                else:
+                    entry[key] = value
+            try:
+                os.makedirs(os.path.dirname(self._cache_path), exist_ok=True)
+                with open(self._cache_path, "w") as f:
+                    json.dump(entry, f)
+                os.chmod(self._cache_path, 0o600)
+            except OSError as e:
+                self.logger.debug(f"Could not update {self._cache_path}: {e}")
+    
+    def _auth_candidates(self) -> list:
+        """List (auth_method, probe, args) for every enabled way of reaching the camera"""
+        probes = self._auth_probes()
+        candidates = []
+        for method in self.auth_strategies:
+            if method == "basic":
+                # HTTP Basic Auth (works with your camera!) on the configured and default ports
+                test_ports = list(dict.fromkeys([self.port, 80, 443]))
+                protocols = ['https', 'http'] if self.port == 443 else ['http', 'https']
+                candidates += [(method, probes[method], (protocol, port))
+                               for protocol in protocols for port in test_ports]
+            else:
+                candidates.append((method, probes[method], ()))
+        return candidates
+    
+    def _tcp_reachable(self, port: int, timeout: float = PROBE_TIMEOUT) -> bool:
+        """Check that the camera accepts TCP connections on port, remembered per authenticate()"""
+        reachable = self._reachable_cache.get(port)
+        if reachable is None:
+            # A firewalled port never answers the SYN; give up after timeout instead of
+            # waiting out the full HTTP request timeout
+            try:
+                with socket.create_connection((self.host, port), timeout=timeout):
+                    reachable = True
+            except OSError:
+                reachable = False
+            self._reachable_cache[port] = reachable
+        return reachable
+    
+    def _try_basic_auth(self, protocol: str, port: int, timeout: float = 10) -> bool:
+        """Try HTTP Basic Authentication on one protocol and port"""
+        if not self._tcp_reachable(port):
+            self.logger.debug(f"Basic Auth {protocol}:{port} skipped: port not reachable")
+            return False
+        try:
+            url = f"{protocol}://{self.host}:{port}/"
+            self.logger.info(f"Testing Basic Auth: {url}")
+            
+            response = self._session.get(url, auth=HTTPBasicAuth(self.username, self.password), 
+                                         timeout=timeout)
+            
+            if response.status_code == 200:
+                self.logger.info(f"✅ HTTP Basic Auth successful via {protocol}:{port}")
+                return True
+            elif response.status_code == 401:
+                self.logger.warning(f"❌ Basic Auth failed: Invalid credentials")
+            else:
+                self.logger.debug(f"Basic Auth {protocol}:{port} returned: {response.status_code}")
+                
+        except Exception as e:
+            self.logger.debug(f"Basic Auth {protocol}:{port} error: {e}")
         
         return False
     
     def _try_rtsp_auth(self) -> bool:
-        """Test RTSP authentication as a fallback"""
-        self.logger.info("Testing RTSP authentication as fallback...")
+        """Test RTSP authentication by opening the stream"""
+        self.logger.info("Testing RTSP authentication...")
         
         # Test if we can open an RTSP stream
         test_cap = self.get_video_stream(channel=0)
         if test_cap:
             test_cap.release()
             self.logger.info("✅ RTSP authentication successful")
-            self.auth_method = "rtsp"
             return True
         
         return False
     
-    def _try_api_auth(self) -> bool:
-        """Try original API authentication method"""
+    def _try_api_auth(self, timeout: float = 10) -> Optional[str]:
+        """Try original API authentication method; returns the session token"""
         self.logger.info("Trying original API authentication...")
+        if not self._tcp_reachable(self.port):
+            self.logger.debug(f"API auth skipped: port {self.port} not reachable")
+            return None
         
         auth_url = f"https://{self.host}:{self.port}/cgi-bin/api.cgi"
         auth_data = {
@@ -102,56 +291,83 @@ class ReolinkClient:
         }
         
         try:
-            response = requests.post(auth_url, json=[auth_data], timeout=10, verify=False)
+            response = self._session.post(auth_url, json=[auth_data], timeout=timeout)
             if response.status_code == 200:
                 try:
                     result = response.json()
                     if result and len(result) > 0 and result[0].get("code") == 0:
                         token_data = result[0].get("value", {}).get("Token")
                         if token_data and "name" in token_data:
-                            self.token = token_data["name"]
                             self.logger.info("✅ API authentication successful")
-                            self.auth_method = "api"
-                            return True
+                            return token_data["name"]
                 except ValueError:
                     pass
         except Exception as e:
             self.logger.debug(f"API auth failed: {e}")
         
-        return False
+        return None
     
+    def _resolve_host(self) -> str:
+        """Resolve the camera hostname to an IPv4 address, cached for RESOLVE_TTL seconds"""
+        now = time.monotonic()
+        if self._resolved_host and now - self._resolved_at < self.RESOLVE_TTL:
+            return self._resolved_host
+        try:
+            self._resolved_host = socket.getaddrinfo(self.host, None, socket.AF_INET)[0][4][0]
+            self._resolved_at = now
+        except OSError as e:
+            # Let the stream library try the name itself
+            self.logger.debug(f"Could not resolve {self.host}: {e}")
+            return self.host
+        return self._resolved_host
+
     def get_stream_url(self, channel: int = 0, stream_type: str = "main") -> str:
         """Get the RTSP stream URL"""
-        return f"rtsp://{self.username}:{self.password}@{self.host}:554/h264Preview_{channel+1:02d}_{stream_type}"
+        host = self._resolve_host()
+        return f"rtsp://{self._rtsp_userinfo}@{host}:554/h264Preview_{channel+1:02d}_{stream_type}"
     
+    def get_stream_urls(self, channel: int = 0) -> list:
+        """Return (format index, RTSP URL) for every URL format, the one that worked last time first"""
+        # Resolved once so each candidate URL doesn't repeat the DNS lookup inside FFmpeg
+        host = self._resolve_host()
+
+        # Each wrong format can block for the whole open timeout, so start with the
+        # one that worked last time
+        order = list(range(len(self._rtsp_templates)))
+        known = self._working_stream_idx.get(channel)
+        if known in order:
+            order.remove(known)
+            order.insert(0, known)
+        return [(idx, self._rtsp_templates[idx].format(host=host, ch=channel + 1)) for idx in order]
+
+    def remember_stream_format(self, channel: int, idx: int):
+        """Try RTSP URL format idx first for this channel from now on"""
+        if self._working_stream_idx.get(channel) != idx:
+            self._working_stream_idx[channel] = idx
+            self._update_cache(stream_url_index={str(ch): fmt for ch, fmt in
+                                                 self._working_stream_idx.items()})
+
     def get_video_stream(self, channel: int = 0) -> Optional[cv2.VideoCapture]:
         """Get OpenCV VideoCapture object for the stream"""
         
-        # Known working RTSP URL patterns for your camera type
-        stream_urls = [
-            f"rtsp://{self.username}:{self.password}@{self.host}:554/h264Preview_{channel+1:02d}_main",
-            f"rtsp://{self.username}:{self.password}@{self.host}:554/h264Preview_{channel+1:02d}_sub",
-            f"rtsp://{self.username}:{self.password}@{self.host}:554/Preview_{channel+1:02d}_main",
-            f"rtsp://{self.username}:{self.password}@{self.host}:554/cam/realmonitor?channel={channel+1}&subtype=0",
-            f"rtsp://{self.username}:{self.password}@{self.host}:554/live",
-            f"rtsp://{self.username}:{self.password}@{self.host}:554/stream1"
-        ]
-        
-        for i, stream_url in enumerate(stream_urls, 1):
-            self.logger.info(f"Trying RTSP URL format {i}/{len(stream_urls)}")
+        for idx, stream_url in self.get_stream_urls(channel):
+            i = idx + 1
+            self.logger.info(f"Trying RTSP URL format {i}/{len(self._rtsp_templates)}")
             
             try:
-                cap = cv2.VideoCapture(stream_url)
+                # Pin the FFmpeg backend; timeouts and hardware decode only take
+                # effect when passed at open time
+                cap = cv2.VideoCapture(stream_url, cv2.CAP_FFMPEG, [
+                    cv2.CAP_PROP_OPEN_TIMEOUT_MSEC, 5000,
+                    cv2.CAP_PROP_READ_TIMEOUT_MSEC, 5000,
+                    cv2.CAP_PROP_HW_ACCELERATION, cv2.VIDEO_ACCELERATION_ANY,
+                ])
                 
                 # Optimize settings to reduce h264 errors
                 cap.set(cv2.CAP_PROP_BUFFERSIZE, 1)  # Minimize buffer
                 cap.set(cv2.CAP_PROP_FPS, 15)        # Limit FPS to reduce errors
                 cap.set(cv2.CAP_PROP_FOURCC, cv2.VideoWriter_fourcc('H','2','6','4'))
                 
-                # Try to set transport protocol to TCP (more reliable than UDP)
-                cap.set(cv2.CAP_PROP_OPEN_TIMEOUT_MSEC, 5000)
-                cap.set(cv2.CAP_PROP_READ_TIMEOUT_MSEC, 5000)
-                
                 if cap.isOpened():
                     # Test if we can actually read a frame
                     ret, frame = cap.read()
@@ -161,6 +377,7 @@ class ReolinkClient:
                         
                         # Reset to beginning
                         cap.set(cv2.CAP_PROP_POS_FRAMES, 0)
+                        self.remember_stream_format(channel, idx)
                         return cap
                     else:
                         self.logger.warning(f"❌ Format {i}: Stream opened but couldn't read frame")
@@ -172,4 +389,35 @@ class ReolinkClient:
                 self.logger.warning(f"❌ Format {i}: Exception - {e}")
         
         self.logger.error("❌ Failed to open RTSP stream with any URL format")
-        return None
\ No newline at end of file
+        return None
+    
+    def get_gstreamer_stream(self, channel: int = 0) -> Optional[cv2.VideoCapture]:
+        """
+        Open the stream through a GStreamer pipeline ending in an appsink.
+        
+        The appsink keeps at most two decoded frames and drops older ones, so a slow
+        consumer always gets the freshest frame. Returns None if OpenCV was built
+        without GStreamer or the pipeline fails to start.
+        """
+        if not _opencv_has_gstreamer():
+            self.logger.warning("OpenCV was built without GStreamer support")
+            return None
+        
+        idx = self._working_stream_idx.get(channel, 0)
+        stream_url = self._rtsp_templates[idx].format(host=self._resolve_host(), ch=channel + 1)
+        pipeline = (
+            f'rtspsrc location="{stream_url}" protocols=tcp latency=0 ! decodebin ! '
+            "videoconvert ! video/x-raw,format=BGR ! "
+            "appsink max-buffers=2 drop=true sync=false"
+        )
+        cap = cv2.VideoCapture(pipeline, cv2.CAP_GSTREAMER)
+        if cap.isOpened():
+            self.logger.info(f"✅ RTSP stream opened through GStreamer with format {idx + 1}")
+            return cap
+        cap.release()
+        self.logger.warning("❌ GStreamer pipeline failed to open")
+        return None
+    
+    def close(self):
+        """Release pooled HTTP connections"""
+        self._session.close()
@@ -4,71 +4,502 @@ import threading
 import numpy as np
 from typing import Callable, Optional, List, Tuple
 from datetime import datetime, timedelta
-from collections import deque
 import logging
 import os
+import uuid
+import queue
+import functools
+from fractions import Fraction
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+try:
+    import av
+except ImportError:  # Without PyAV, segment recordings always use cv2.VideoWriter
+    av = None
+
+# Times a recording re-copies its frames when capture overwrites them mid-copy
+SNAPSHOT_ATTEMPTS = 3
+
+# Results of this many completed recordings are kept for wait_for_recording
+FINISHED_RECORDINGS_KEPT = 256
+
+# H.264 encoders for PyAV recordings, hardware first
+H264_ENCODERS = ("h264_nvenc", "h264_qsv", "libx264")
+
+@functools.lru_cache(maxsize=None)
+def _h264_encoder() -> Optional[str]:
+    """Return the first H.264 encoder in H264_ENCODERS that opens on this machine."""
+    for codec in H264_ENCODERS:
+        try:
+            ctx = av.CodecContext.create(codec, "w")
+            ctx.width, ctx.height, ctx.pix_fmt = 640, 480, "yuv420p"
+            ctx.time_base = Fraction(1, 30)
+            ctx.open()
+            return codec
+        except Exception:  # Not built in, or no device / driver for it
+            continue
+    return None
+
+def _frame_rate(fps: float) -> Fraction:
+    """Return fps as an exact rate, mapping NTSC rates like 29.97 to 30000/1001"""
+    # limit_denominator alone would make 29.97 2997/100, not the 30000/1001 encoders expect
+    ntsc = Fraction(round(fps * 1.001) * 1000, 1001)
+    if abs(ntsc - Fraction(fps)) < Fraction(1, 200):
+        return ntsc
+    return Fraction(fps).limit_denominator(1001)
+
+class _AVWriter:
+    """Minimal cv2.VideoWriter stand-in that encodes H.264 with PyAV."""
+    
+    def __init__(self, path: str, codec: str, fps: float, size: Tuple[int, int]):
+        self._container = av.open(path, mode="w")
+        options = {"preset": "ultrafast"} if codec == "libx264" else {}
+        self._stream = self._container.add_stream(codec, rate=_frame_rate(fps), options=options)
+        self._stream.width, self._stream.height = size
+        self._stream.pix_fmt = "yuv420p"
+    
+    def isOpened(self) -> bool:
+        return True
+    
+    def write(self, frame: np.ndarray):
+        self._container.mux(self._stream.encode(av.VideoFrame.from_ndarray(frame, format="bgr24")))
+    
+    def release(self):
+        self._container.mux(self._stream.encode())  # Flush delayed frames
+        self._container.close()
+
+class FrameRing:
+    """
+    Fixed-size ring of timestamped frames with one writer and any number of readers.
+
+    Frames live in one preallocated (capacity, H, W, C) array with a parallel array
+    of timestamps, so buffering a frame never allocates. The writer fills a slot
+    before advancing the head, so readers need no lock, but a slot chosen by a reader
+    can be overwritten before the reader copies it. Readers note the head before
+    choosing slots and check them with overwritten() after copying.
+    """
+    
+    __slots__ = ('capacity', 'frames', 'timestamps', '_head')
+    
+    def __init__(self, capacity: int):
+        self.capacity = capacity
+        self.frames = None  # Allocated once the first frame shows the stream geometry
+        self.timestamps = np.zeros(capacity, dtype=np.int64)  # time.time_ns() at capture
+        self._head = 0  # Total frames ever appended
+    
+    def __len__(self) -> int:
+        return min(self._head, self.capacity)
+    
+    @property
+    def head(self) -> int:
+        """Total frames ever appended"""
+        return self._head
+    
+    def overwritten(self, slots: np.ndarray, head: int) -> bool:
+        """Return whether the writer has started replacing any of slots, which were
+        chosen when the head was at head"""
+        # Each slot held the newest frame before head that maps to it; the writer
+        # reaches the oldest of those once it is a full ring further on
+        oldest = head - 1 - int(((head - 1 - slots) % self.capacity).max())
+        return self._head >= oldest + self.capacity
+    
+    def next_slot(self) -> Optional[np.ndarray]:
+        """Return the slot the next frame will occupy, for decoding straight into it"""
+        if self.frames is None:
+            return None
+        return self.frames[self._head % self.capacity]
+    
+    def append(self, timestamp: int, frame: np.ndarray) -> np.ndarray:
+        """Store frame (copying it unless it was decoded into next_slot()) and return its slot"""
+        if self.frames is None or self.frames.shape[1:] != frame.shape or self.frames.dtype != frame.dtype:
+            # First frame, or the stream changed resolution; older frames can't be kept
+            self.frames = np.empty((self.capacity, *frame.shape), dtype=frame.dtype)
+            self._head = 0
+        idx = self._head % self.capacity
+        slot = self.frames[idx]
+        if not np.may_share_memory(slot, frame):
+            np.copyto(slot, frame)
+        self.timestamps[idx] = timestamp
+        self._head += 1
+        return slot
+    
+    def slot_indices(self) -> np.ndarray:
+        """Return the indices of the filled slots, oldest first. Once the ring is full the
+        oldest slot is left out, since the writer may be replacing it."""
+        head = self._head
+        first = head - min(head, self.capacity)
+        # Slot i is intact only if the writer hasn't started on i + capacity
+        first = max(first, self._head - self.capacity + 1)
+        return np.arange(first, head) % self.capacity
+    
+    def frames_at(self, times: np.ndarray) -> Optional[np.ndarray]:
+        """
+        For each epoch-nanosecond time in times, return the slot of the latest frame
+        captured at or before it. Times before the oldest buffered frame map to the oldest frame.
+        Returns None if no intact frame is buffered.
+        """
+        indices = self.slot_indices()
+        if indices.size == 0:
+            return None
+        # Timestamps are in capture order, so two binary searches replace a scan
+        pos = np.searchsorted(self.timestamps[indices], times, side="right") - 1
+        return indices[np.clip(pos, 0, None)]
 
 class StreamHandler:
     """Handle video stream processing and frame management"""
     
-    def __init__(self, video_capture: cv2.VideoCapture, buffer_seconds: int = 30):
+    __slots__ = ('cap', 'is_running', 'current_frame', 'logger', 'buffer_seconds',
+                 'frame_buffer', 'recording_lock', '_writer_pool', '_recordings', 'encoder', 'fps',
+                 'frame_ready', '_finished')
+    
+    def __init__(self, video_capture: cv2.VideoCapture, buffer_seconds: int = 30,
+                 encoder: str = "opencv"):
+        """encoder is "opencv" (mp4v via cv2.VideoWriter) or "pyav" (H.264, hardware when available)"""
         self.cap = video_capture
+        # Keep the backend from queueing decoded frames; a late read should get a fresh one
+        self.cap.set(cv2.CAP_PROP_BUFFERSIZE, 1)
+        # The camera's own rate sizes the buffer and paces recordings; 0 means unknown
+        fps = self.cap.get(cv2.CAP_PROP_FPS)
+        self.fps = fps if fps > 0 else 30
         self.is_running = False
         self.current_frame = None
-        self.frame_lock = threading.Lock()
+        # Set once the stream has delivered its first frame
+        self.frame_ready = threading.Event()
         self.logger = logging.getLogger(__name__)
         
         # Frame buffer for segment recording
         self.buffer_seconds = buffer_seconds
-        self.frame_buffer = deque(maxlen=buffer_seconds * 30)  # Assuming 30 FPS
-        self.buffer_lock = threading.Lock()
+        # At least two slots: the one being written is never read, so one slot holds nothing
+        self.frame_buffer = FrameRing(max(round(buffer_seconds * self.fps), 2))
         
-        # Recording state (simplified - no longer needed for active recordings)
+        # Guards _recordings and _finished, which writer threads update as files complete
         self.recording_lock = threading.Lock()
+        # Segment files are encoded off the caller's thread; futures by recording id
+        self._writer_pool = ThreadPoolExecutor(max_workers=2, thread_name_prefix="segment-writer")
+        self._recordings = {}
+        # Results of completed recordings nobody has waited on yet, oldest first; capped so
+        # fire-and-forget callers don't grow it without bound
+        self._finished = OrderedDict()
+        self.encoder = encoder
+        
+    def start_stream(self, frame_callback: Optional[Callable] = None, max_fps: Optional[float] = None,
+                     callback_thread: bool = False):
+        """
+        Start processing the video stream, optionally capping the frame rate.
         
-    def start_stream(self, frame_callback: Optional[Callable] = None):
-        """Start processing the video stream"""
+        With callback_thread, frame_callback runs on its own thread so slow processing
+        never holds up capture; it then skips frames that arrive while it is busy.
+        frame_callback receives a read-only view of the buffered frame, not a copy.
+        """
         self.is_running = True
-        thread = threading.Thread(target=self._stream_loop, args=(frame_callback,))
+        if frame_callback and callback_thread:
+            frame_callback = self._threaded_callback(frame_callback)
+        thread = threading.Thread(target=self._stream_loop, args=(frame_callback, max_fps))
         thread.daemon = True
         thread.start()
         return thread
     
-    def _stream_loop(self, frame_callback: Optional[Callable] = None):
+    def _threaded_callback(self, frame_callback: Callable) -> Callable:
+        """Wrap frame_callback to hand frames to a worker thread, newest frame first"""
+        pending = queue.Queue(maxsize=1)
+        
+        def worker():
+            while self.is_running:
+                try:
+                    frame = pending.get(timeout=0.5)
+                except queue.Empty:
+                    continue
+                try:
+                    frame_callback(frame)
+                except Exception as e:
+                    self.logger.error(f"Error in frame callback: {e}")
+        
+        def submit(frame):
+            try:
+                pending.put_nowait(frame)
+            except queue.Full:
+                # Still busy; the frame waiting its turn is stale now, so swap it out
+                try:
+                    pending.get_nowait()
+                except queue.Empty:
+                    pass
+                pending.put_nowait(frame)
+        
+        threading.Thread(target=worker, name="frame-callback", daemon=True).start()
+        return submit
+    
+    def _stream_loop(self, frame_callback: Optional[Callable] = None, max_fps: Optional[float] = None):
         """Main stream processing loop"""
+        # read() blocks until the camera delivers the next frame, so the stream sets the
+        # pace; max_fps only holds the loop back for a callback that can't keep up
+        period = 1.0 / max_fps if max_fps else 0.0
+        frame_period = 1.0 / self.fps
+        max_stale = self._stale_frame_limit()
+        deadline = time.perf_counter()
+        read_done = deadline
         while self.is_running:
-            ret, frame = self.cap.read()
+            # Frames that arrived while the last one was being handled are stale; grab()
+            # drops them without the color conversion and copy that retrieving costs.
+            # The newest one is left for read().
+            stale = min(int((time.perf_counter() - read_done) / frame_period) - 1, max_stale)
+            for _ in range(stale):
+                grab_start = time.perf_counter()
+                if not self.cap.grab():
+                    break
+                # A grab that had to wait got a live frame, so the backlog is gone;
+                # grabbing on would throw fresh frames away
+                if time.perf_counter() - grab_start > frame_period / 2:
+                    break
+            
+            # Decode straight into the buffer slot this frame will occupy
+            slot = self.frame_buffer.next_slot()
+            ret, frame = self.cap.read(slot) if slot is not None else self.cap.read()
+            read_done = time.perf_counter()
             
             if not ret:
                 self.logger.warning("Failed to read frame from stream")
                 time.sleep(0.1)
                 continue
             
-            current_time = datetime.now()
-            
-            # Update current frame
-            with self.frame_lock:
-                self.current_frame = frame.copy()
+            # An integer clock read; converted to datetime only when a recording asks
+            current_time = time.time_ns()
             
-            # Add frame to buffer with timestamp
-            with self.buffer_lock:
-                self.frame_buffer.append((current_time, frame.copy()))
+            # Add frame to buffer with timestamp; the current frame shares its slot
+            frame = self.frame_buffer.append(current_time, frame)
+            # A single reference store, atomic under the GIL, so readers need no lock.
+            # A free-threaded build would need a lock around this and the read side again.
+            self.current_frame = frame
+            if not self.frame_ready.is_set():
+                self.frame_ready.set()
             
             if frame_callback:
+                # The frame is the ring slot later recordings copy from, so the callback
+                # gets a read-only view; one that edits frames has to copy first
+                view = frame.view()
+                view.flags.writeable = False
                 try:
-                    frame_callback(frame)
+                    frame_callback(view)
                 except Exception as e:
                     self.logger.error(f"Error in frame callback: {e}")
             
-            time.sleep(0.033)  # ~30 FPS
+            if period:
+                deadline += period
+                delay = deadline - time.perf_counter()
+                if delay > 0:
+                    time.sleep(delay)
+                else:
+                    deadline = time.perf_counter()  # Behind schedule; don't try to catch up
+    
+    def _stale_frame_limit(self) -> int:
+        """
+        Return how many queued frames _stream_loop may skip with grab() at once.
+        
+        Skipping estimates the backlog from the frame period, which only holds when the
+        backend queues every frame at a known rate. GStreamer's appsink (max-buffers=2
+        drop=true) already discards stale frames, and without a reported FPS the period
+        is a guess, so neither skips at all; otherwise at most a second's worth per pass.
+        """
+        try:
+            if self.cap.getBackendName() == "GSTREAMER":
+                return 0
+        except cv2.error:  # No backend, e.g. the capture failed to open
+            return 0
+        if self.cap.get(cv2.CAP_PROP_FPS) <= 0:
+            return 0
+        return int(self.fps)
+    
+    def get_current_frame(self, out: Optional[np.ndarray] = None) -> Optional[np.ndarray]:
+        """Get a copy of the most recent frame, written into out if given (and returned)"""
+        frame = self.current_frame  # One snapshot of the reference; see _stream_loop
+        if frame is None:
+            return None
+        if out is None:
+            return frame.copy()
+        # Lets a caller polling at frame rate reuse one buffer instead of allocating
+        np.copyto(out, frame)
+        return out
+    
+    def start_segment_recording(self, start_time: datetime, end_time: datetime,
+                                output_path: str, fps: Optional[float] = None) -> Optional[str]:
+        """
+        Write the buffered frames between start_time and end_time to output_path, at
+        fps frames per second (the stream's own rate by default).
+        
+        Returns a recording id, or None if nothing could be recorded. End times in the
+        future are clipped to now; the buffer only holds frames already captured.
+        """
+        recording_ids = self._record_windows([(start_time, end_time, output_path)], fps)
+        return recording_ids[0] if recording_ids else None
+    
+    def record_segment_from_timestamps(self, timestamps: List[Tuple[datetime, datetime]],
+                                       output_dir: str, fps: Optional[float] = None) -> List[str]:
+        """Record one file per (start_time, end_time) pair into output_dir and return their ids"""
+        windows = [(start_time, end_time,
+                    os.path.join(output_dir, f"segment_{i:03d}_{start_time:%Y%m%d_%H%M%S}.mp4"))
+                   for i, (start_time, end_time) in enumerate(timestamps)]
+        return self._record_windows(windows, fps)
+    
+    def _record_windows(self, windows: List[Tuple[datetime, datetime, str]],
+                        fps: Optional[float]) -> List[str]:
+        """Start recording each (start_time, end_time, output_path) window; returns the ids started"""
+        fps = fps or self.fps
+        now = datetime.now()
+        valid = []
+        for start_time, end_time, output_path in windows:
+            if end_time > now:
+                self.logger.warning(f"End time {end_time} is in the future, recording until {now}")
+                end_time = now
+            if end_time <= start_time:
+                self.logger.error(f"Empty recording window: {start_time} - {end_time}")
+                continue
+            valid.append((start_time, end_time, output_path))
+        if not valid:
+            return []
+        indices = self.frame_buffer.slot_indices()
+        if indices.size == 0:
+            self.logger.error("No frames buffered to record from")
+            return []
+        # A window that ended before the oldest buffered frame has no footage left;
+        # recording it would only repeat that frame
+        oldest = datetime.fromtimestamp(self.frame_buffer.timestamps[indices[0]] / 1e9)
+        missing = [window for window in valid if window[1] <= oldest]
+        for start_time, end_time, _ in missing:
+            self.logger.error(f"No buffered frames for {start_time} - {end_time}; "
+                              f"the oldest frame is from {oldest}")
+        valid = [window for window in valid if window[1] > oldest]
+        if not valid:
+            return []
+        
+        # One pass over the ring for every window; frames shared by overlapping
+        # windows are copied once
+        snapshot = self._snapshot_frames([(start, end) for start, end, _ in valid], fps)
+        if snapshot is None:
+            self.logger.error("No frames buffered to record from")
+            return []
+        frames, orders = snapshot
+        
+        height, width = frames.shape[1:3]
+        recording_ids = []
+        for (_, _, output_path), order in zip(valid, orders):
+            writer = self._open_writer(output_path, fps, (width, height))
+            if writer is None or not writer.isOpened():
+                self.logger.error(f"Could not open video writer for {output_path}")
+                continue
+            # Encoding happens on a writer thread so neither the caller nor the
+            # capture thread waits on the muxer
+            recording_id = uuid.uuid4().hex
+            future = self._writer_pool.submit(
+                self._encode, writer, frames, order, output_path, recording_id)
+            with self.recording_lock:
+                self._recordings[recording_id] = future
+            future.add_done_callback(functools.partial(self._recording_done, recording_id))
+            recording_ids.append(recording_id)
+        return recording_ids
+    
+    def _open_writer(self, output_path: str, fps: float, size: Tuple[int, int]):
+        if self.encoder == "pyav":
+            codec = _h264_encoder() if av is not None else None
+            if codec is not None:
+                try:
+                    return _AVWriter(output_path, codec, fps, size)
+                except Exception as e:
+                    self.logger.error(f"Could not open {codec} writer for {output_path}: {e}")
+                    return None
+            self.logger.warning("No PyAV H.264 encoder available, falling back to mp4v")
+        return cv2.VideoWriter(output_path, cv2.VideoWriter_fourcc(*'mp4v'), fps, size)
+    
+    def _recording_done(self, recording_id: str, future):
+        """Move a finished recording's result from _recordings to _finished"""
+        ok = future.exception() is None and future.result()
+        with self.recording_lock:
+            # Gone already if a waiter got the result before this callback ran
+            if self._recordings.pop(recording_id, None) is None:
+                return
+            self._finished[recording_id] = ok
+            while len(self._finished) > FINISHED_RECORDINGS_KEPT:
+                self._finished.popitem(last=False)
+    
+    def wait_for_recording(self, recording_id: str, timeout: Optional[float] = None) -> bool:
+        """
+        Block until a recording has been written; returns False if it failed.
+        
+        Each id can be waited on once. Raises ValueError for an id that is unknown,
+        was already waited on, or finished too long ago to still be remembered.
+        """
+        with self.recording_lock:
+            if recording_id in self._finished:
+                return self._finished.pop(recording_id)
+            future = self._recordings.get(recording_id)
+        if future is None:
+            raise ValueError(f"Unknown recording id: {recording_id}")
+        ok = future.result(timeout=timeout)
+        with self.recording_lock:
+            self._recordings.pop(recording_id, None)
+            self._finished.pop(recording_id, None)
+        return ok
+    
+    def _snapshot_frames(self, windows: List[Tuple[datetime, datetime]],
+                         fps: float) -> Optional[Tuple[np.ndarray, List[np.ndarray]]]:
+        """
+        Copy out the frames covering each (start_time, end_time) window at a constant fps.
+        
+        Returns the distinct frames and, per window, an index into them for each output
+        frame. The copy keeps the capture thread free to overwrite those slots while
+        they're encoded. If the capture thread reaches a chosen slot before it's copied,
+        the frames are chosen and copied again. Returns None if no frame is buffered, as
+        after the stream changed resolution.
+        """
+        # The writer's frame rate is fixed while capture timing isn't, so each output frame
+        # shows whatever frame was current at its time; that keeps the clip duration right
+        step = round(1e9 / fps)
+        ring = self.frame_buffer
+        indices = ring.slot_indices()
+        if indices.size == 0:
+            return None
+        oldest = ring.timestamps[indices[0]]
+        times, bounds = [], [0]
+        for start_time, end_time in windows:
+            count = max(int((end_time - start_time).total_seconds() * fps), 1)
+            start_ns = int(start_time.timestamp() * 1e9)
+            if start_ns < oldest:
+                self.logger.warning(f"Start time {start_time} predates the buffer, padding with "
+                                    f"the oldest frame from {datetime.fromtimestamp(oldest / 1e9)}")
+            times.append(start_ns + step * np.arange(count, dtype=np.int64))
+            bounds.append(bounds[-1] + count)
+        
+        times = np.concatenate(times)
+        for attempt in range(SNAPSHOT_ATTEMPTS):
+            head = ring.head
+            slots = ring.frames_at(times)
+            if slots is None:
+                return None
+            slots, order = np.unique(slots, return_inverse=True)
+            frames = ring.frames[slots]
+            if not ring.overwritten(slots, head):
+                break
+        else:
+            self.logger.warning(f"Capture kept overwriting frames being copied after "
+                                f"{SNAPSHOT_ATTEMPTS} attempts; the oldest recorded frames "
+                                f"may be newer than requested")
+        return frames, [order[a:b] for a, b in zip(bounds, bounds[1:])]
     
-    def get_current_frame(self) -> Optional[np.ndarray]:
-        """Get the most recent frame"""
-        with self.frame_lock:
-            return self.current_frame.copy() if self.current_frame is not None else None
+    def _encode(self, writer: cv2.VideoWriter, frames: np.ndarray, order: np.ndarray,
+                output_path: str, recording_id: str) -> bool:
+        try:
+            for i in order:
+                writer.write(frames[i])
+        except Exception as e:
+            self.logger.error(f"Error writing {output_path}: {e}")
+            return False
+        finally:
+            writer.release()
+        self.logger.info(f"Recorded {len(order)} frames to {output_path} ({recording_id})")
+        return True
     
     def stop_stream(self):
-        """Stop the stream processing"""
+        """Stop the stream processing, finishing any recordings still being written"""
         self.is_running = False
         if self.cap:
             self.cap.release()
+        self._writer_pool.shutdown(wait=True)
@@ -8,8 +8,43 @@ rotation, and different log levels for different components.
 import logging
 import logging.handlers
 import os
+import queue
+import atexit
+import threading
+import time
+from time import perf_counter_ns
 from datetime import datetime
-from typing import Optional
+from typing import Dict, Optional
+
+# One rotating handler per log file, shared by every logger that writes to it, so a
+# file has one descriptor and rotation isn't attempted by several handlers at once.
+# Loggers get a QueueHandler in front of it; a listener thread does the file I/O.
+_file_handlers: Dict[str, logging.handlers.QueueHandler] = {}
+_file_handlers_lock = threading.Lock()
+_listeners = []
+
+class _SecondCachedFormatter(logging.Formatter):
+    """Formatter that renders asctime once per second instead of once per record."""
+
+    def __init__(self, fmt: str, datefmt: str):
+        super().__init__(fmt=fmt, datefmt=datefmt)
+        # (whole second, rendered string), swapped as one tuple so the console and
+        # listener threads sharing this formatter never see a mismatched pair
+        self._last_second = (None, "")
+
+    def formatTime(self, record: logging.LogRecord, datefmt: Optional[str] = None) -> str:
+        second = int(record.created)
+        cached_second, text = self._last_second
+        if second != cached_second:
+            text = time.strftime(datefmt or self.datefmt, self.converter(second))
+            self._last_second = (second, text)
+        return text
+
+@atexit.register
+def _stop_listeners():
+    """Flush queued records to their files before the interpreter exits."""
+    for listener in _listeners:
+        listener.stop()
 
 def setup_logger(
     name: str = "reolink_processor",
@@ -44,31 +79,43 @@ def setup_logger(
     if logger.handlers:
         return logger
     
-    # Create log directory if it doesn't exist
-    os.makedirs(log_dir, exist_ok=True)
-    
     # Generate log file name if not provided
     if log_file is None:
         timestamp = datetime.now().strftime("%Y%m%d")
         log_file = f"{name}_{timestamp}.log"
     
-    log_path = os.path.join(log_dir, log_file)
+    log_path = os.path.abspath(os.path.join(log_dir, log_file))
     
     # Create formatter
-    formatter = logging.Formatter(
+    formatter = _SecondCachedFormatter(
         fmt='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
         datefmt='%Y-%m-%d %H:%M:%S'
     )
     
     # File handler with rotation
-    file_handler = logging.handlers.RotatingFileHandler(
-        log_path,
-        maxBytes=max_file_size,
-        backupCount=backup_count
-    )
-    file_handler.setLevel(logging.DEBUG)  # File gets all levels
-    file_handler.setFormatter(formatter)
-    logger.addHandler(file_handler)
+    with _file_handlers_lock:
+        queue_handler = _file_handlers.get(log_path)
+        if queue_handler is None:
+            # Create log directory if it doesn't exist
+            os.makedirs(log_dir, exist_ok=True)
+            file_handler = logging.handlers.RotatingFileHandler(
+                log_path,
+                maxBytes=max_file_size,
+                backupCount=backup_count,
+                delay=True  # Opened on the first record
+            )
+            file_handler.setLevel(logging.DEBUG)  # File gets all levels
+            file_handler.setFormatter(formatter)
+            # Logging calls only enqueue; writes and rotation happen on the listener
+            # thread, so they never block the capture loop
+            queue_handler = logging.handlers.QueueHandler(queue.SimpleQueue())
+            listener = logging.handlers.QueueListener(
+                queue_handler.queue, file_handler, respect_handler_level=True
+            )
+            listener.start()
+            _listeners.append(listener)
+            _file_handlers[log_path] = queue_handler
+    logger.addHandler(queue_handler)
     
     # Console handler (optional)
     if console_output:
@@ -182,15 +229,16 @@ def log_performance(logger: logging.Logger):
     """
     def decorator(func):
         def wrapper(*args, **kwargs):
-            import time
-            start_time = time.time()
+            start_time = perf_counter_ns()
             try:
                 result = func(*args, **kwargs)
-                execution_time = time.time() - start_time
-                logger.info(f"{func.__name__} completed in {execution_time:.3f}s")
+                # Skip formatting the message entirely when INFO is filtered out
+                if logger.isEnabledFor(logging.INFO):
+                    execution_time = (perf_counter_ns() - start_time) * 1e-9
+                    logger.info(f"{func.__name__} completed in {execution_time:.3f}s")
                 return result
             except Exception as e:
-                execution_time = time.time() - start_time
+                execution_time = (perf_counter_ns() - start_time) * 1e-9
                 logger.error(f"{func.__name__} failed after {execution_time:.3f}s: {e}")
                 raise
         return wrapper
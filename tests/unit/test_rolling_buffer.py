@@ -0,0 +1,79 @@
+"""
+Unit tests for the rolling buffer.
+
+Tests segment timing and clip remuxing on small synthetic segments
+written with PyAV.
+"""
+
+import unittest
+import tempfile
+import os
+from datetime import datetime, timedelta
+import numpy as np
+
+from processing import rolling_buffer
+from processing.rolling_buffer import RollingBuffer
+
+
+@unittest.skipIf(rolling_buffer.av is None, "PyAV is not installed")
+class TestRollingBuffer(unittest.TestCase):
+    """Test cases for RollingBuffer class."""
+
+    FPS = 25
+    # Keyframe-cut segments don't start on whole seconds: these open at
+    # 0.5 s, 1.7 s and 2.9 s past BASE, so their names are 1.2 s apart at most
+    BASE = datetime(2024, 1, 1, 10, 0, 0)
+    OFFSETS = (0.5, 1.7, 2.9)
+    SEGMENT_FRAMES = 30
+
+    @classmethod
+    def _write_segment(cls, path):
+        """Write one segment that starts on a keyframe and restarts its timestamps at zero."""
+        av = rolling_buffer.av
+        frame = np.zeros((64, 64, 3), dtype=np.uint8)
+        with av.open(path, mode="w") as output:
+            stream = output.add_stream("mpeg4", rate=cls.FPS)
+            stream.width, stream.height, stream.pix_fmt = 64, 64, "yuv420p"
+            stream.codec_context.gop_size = cls.SEGMENT_FRAMES
+            for i in range(cls.SEGMENT_FRAMES):
+                video_frame = av.VideoFrame.from_ndarray(frame, format="rgb24")
+                video_frame.pts = i
+                output.mux(stream.encode(video_frame))
+            output.mux(stream.encode())
+
+    def setUp(self):
+        """Fill a fresh buffer with three closed segments."""
+        self.temp_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(self.temp_dir.cleanup)
+        self.buffer = RollingBuffer(buffer_dir=self.temp_dir.name)
+        self.segments = []
+        for offset in self.OFFSETS:
+            name_start = (self.BASE + timedelta(seconds=offset)).replace(microsecond=0)
+            path = os.path.join(self.temp_dir.name, name_start.strftime("segment_%Y%m%d_%H%M%S.mp4"))
+            self._write_segment(path)
+            self.segments.append((name_start, path))
+
+    def test_segment_times_follow_real_durations(self):
+        """Test that a segment continuing the previous one starts where it ended."""
+        starts, ends, _ = self.buffer._segment_index()
+        segment = timedelta(seconds=self.SEGMENT_FRAMES / self.FPS)
+        self.assertEqual(starts[1], self.BASE + segment)
+        self.assertEqual(starts[2], self.BASE + 2 * segment)
+        self.assertEqual(ends[0], starts[1])
+        self.assertIsNone(ends[2])
+
+    def test_remux_across_segments(self):
+        """Test that a clip spanning every segment muxes with increasing timestamps."""
+        output_path = os.path.join(self.temp_dir.name, "clip.mp4")
+        self.buffer._remux_segments(self.segments, self.BASE + timedelta(seconds=0.5), 2, output_path)
+
+        with rolling_buffer.av.open(output_path) as clip:
+            dts = [packet.dts for packet in clip.demux(video=0) if packet.dts is not None]
+        # The clip starts on the first keyframe and runs 2 s past the requested start,
+        # so it holds every frame before 2.5 s: 0, 0.04, ... 2.48
+        self.assertEqual(len(dts), 63)
+        self.assertTrue(all(a < b for a, b in zip(dts, dts[1:])))
+
+
+if __name__ == '__main__':
+    unittest.main()
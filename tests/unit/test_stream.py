@@ -6,187 +6,306 @@ using mocks and fixtures.
 """
 
 import unittest
-from unittest.mock import Mock, patch, MagicMock
+from unittest.mock import Mock, patch
 import cv2
 import numpy as np
 from datetime import datetime, timedelta
 import tempfile
+import shutil
+import time
+import queue
 import os
 
-from stream.stream_handler import StreamHandler
+from stream.stream_handler import StreamHandler, FrameRing
 from stream.reolink_client import ReolinkClient
 
 
 class TestStreamHandler(unittest.TestCase):
     """Test cases for StreamHandler class."""
     
-    def setUp(self):
-        """Set up test fixtures before each test method."""
-        self.mock_cap = Mock(spec=cv2.VideoCapture)
-        self.mock_cap.isOpened.return_value = True
-        self.mock_cap.read.return_value = (True, np.zeros((480, 640, 3), dtype=np.uint8))
-        
-        self.stream_handler = StreamHandler(self.mock_cap, buffer_seconds=10)
+    # Every mocked read() returns this one frame; read-only so the handler can't write to it
+    _ZERO_FRAME = np.zeros((480, 640, 3), dtype=np.uint8)
+    _ZERO_FRAME.setflags(write=False)
+    
+    @classmethod
+    def _paced_read(cls, *args):
+        """Deliver a frame every 10 ms, like a camera, so the capture thread doesn't spin"""
+        time.sleep(0.01)
+        return True, cls._ZERO_FRAME
+    
+    @classmethod
+    def setUpClass(cls):
+        """Start one capture thread that the tests reading live frames share."""
+        cls.mock_cap = Mock(spec=cv2.VideoCapture)
+        cls.mock_cap.isOpened.return_value = True
+        cls.mock_cap.read.side_effect = cls._paced_read
+        cls.mock_cap.get.return_value = 30.0  # CAP_PROP_FPS
         
-        # Create temporary directory for test outputs
-        self.temp_dir = tempfile.mkdtemp()
+        cls.stream_handler = StreamHandler(cls.mock_cap, buffer_seconds=10)
+        cls.stream_thread = cls.stream_handler.start_stream()
     
-    def tearDown(self):
-        """Clean up after each test method."""
-        self.stream_handler.stop_stream()
+    @classmethod
+    def tearDownClass(cls):
+        """Stop the shared capture thread."""
+        cls.stream_handler.stop_stream()
+    
+    def setUp(self):
+        """Give each test a mocked cv2.VideoWriter."""
+        # The shared handler's buffer is never reset: its capture thread is the ring's only
+        # writer, and its tests just need a frame. Recording tests get their own handler
+        # from _buffered_handler().
+        
+        # Writers are mocked, so recordings only need a path to pass along, never a real directory
+        self.output_dir = "segments"
         
-        # Clean up temporary files
-        import shutil
-        shutil.rmtree(self.temp_dir, ignore_errors=True)
+        # No test should encode real video; recording tests configure it via _make_writer()
+        patcher = patch('cv2.VideoWriter')
+        self.mock_video_writer = patcher.start()
+        self.addCleanup(patcher.stop)
     
     def test_stream_handler_initialization(self):
         """Test StreamHandler initializes correctly."""
-        self.assertFalse(self.stream_handler.is_running)
-        self.assertIsNone(self.stream_handler.current_frame)
-        self.assertEqual(len(self.stream_handler.frame_buffer), 0)
+        stream_handler = StreamHandler(self.mock_cap, buffer_seconds=10)
+        self.addCleanup(stream_handler.stop_stream)
+        self.assertFalse(stream_handler.is_running)
+        self.assertIsNone(stream_handler.current_frame)
+        self.assertIsNone(stream_handler.get_current_frame())
+        self.assertEqual(len(stream_handler.frame_buffer), 0)
+    
+    def test_frame_callback_gets_read_only_frame(self):
+        """Test that frame_callback can't write into the buffered frame."""
+        frames = queue.Queue()
+        stream_handler = StreamHandler(self.mock_cap, buffer_seconds=1)
+        self.addCleanup(stream_handler.stop_stream)
+        stream_handler.start_stream(frames.put)
+        
+        frame = frames.get(timeout=1.0)
+        self.assertFalse(frame.flags.writeable)
+        self.assertTrue(stream_handler.frame_buffer.frames.flags.writeable)
     
     def test_start_stream(self):
         """Test starting the video stream."""
-        thread = self.stream_handler.start_stream()
         self.assertTrue(self.stream_handler.is_running)
-        self.assertIsNotNone(thread)
+        self.assertTrue(self.stream_thread.is_alive())
         
-        # Wait a bit for thread to process frames
-        import time
-        time.sleep(0.1)
+        self.assertTrue(self.stream_handler.frame_ready.wait(timeout=1.0))
         
         # Check that frames are being captured
         self.assertIsNotNone(self.stream_handler.get_current_frame())
     
     def test_get_current_frame(self):
         """Test getting the current frame."""
-        # Before starting stream
-        self.assertIsNone(self.stream_handler.get_current_frame())
-        
-        # After starting stream
-        self.stream_handler.start_stream()
-        import time
-        time.sleep(0.1)  # Allow time for frame capture
+        self.assertTrue(self.stream_handler.frame_ready.wait(timeout=1.0))
         
         frame = self.stream_handler.get_current_frame()
         self.assertIsNotNone(frame)
         self.assertEqual(frame.shape, (480, 640, 3))
     
-    @patch('cv2.VideoWriter')
-    def test_segment_recording_historical(self, mock_video_writer):
-        """Test recording a historical segment."""
+    def test_get_current_frame_into_buffer(self):
+        """Test copying the current frame into a caller-owned buffer."""
+        self.assertTrue(self.stream_handler.frame_ready.wait(timeout=1.0))
+        
+        out = np.empty((480, 640, 3), dtype=np.uint8)
+        frame = self.stream_handler.get_current_frame(out=out)
+        self.assertIs(frame, out)
+    
+    def test_buffered_frame_is_copied_from_capture(self):
+        """Test frames the backend didn't decode into the buffer are copied into it."""
+        self.assertTrue(self.stream_handler.frame_ready.wait(timeout=1.0))
+        
+        current = self.stream_handler.current_frame
+        self.assertFalse(np.may_share_memory(current, self._ZERO_FRAME))
+        self.assertTrue(current.flags.writeable)
+    
+    def _buffered_handler(self, seconds: float = 10.0, interval: float = 0.1) -> StreamHandler:
+        """Return an unstarted handler whose buffer holds one small frame every interval
+        over the last seconds, so recording tests don't depend on the capture thread."""
+        stream_handler = StreamHandler(self.mock_cap, buffer_seconds=10)
+        self.addCleanup(stream_handler.stop_stream)
+        now_ns = time.time_ns()
+        frame = np.zeros((48, 64, 3), dtype=np.uint8)
+        for i in range(int(seconds / interval), -1, -1):
+            stream_handler.frame_buffer.append(now_ns - int(i * interval * 1e9), frame)
+        return stream_handler
+    
+    def _make_writer(self) -> Mock:
+        """Return the mock writer that cv2.VideoWriter will hand out, already open."""
         mock_writer = Mock()
-        mock_video_writer.return_value = mock_writer
         mock_writer.isOpened.return_value = True
-        
-        # Start stream to populate buffer
-        self.stream_handler.start_stream()
-        import time
-        time.sleep(0.2)  # Allow buffer to populate
+        self.mock_video_writer.return_value = mock_writer
+        return mock_writer
+    
+    def test_segment_recording_historical(self):
+        """Test recording a historical segment."""
+        mock_writer = self._make_writer()
+        stream_handler = self._buffered_handler()
         
         # Record a historical segment
         now = datetime.now()
         start_time = now - timedelta(seconds=5)
         end_time = now - timedelta(seconds=2)
         
-        output_path = os.path.join(self.temp_dir, "test_segment.mp4")
-        recording_id = self.stream_handler.start_segment_recording(
+        output_path = os.path.join(self.output_dir, "test_segment.mp4")
+        recording_id = stream_handler.start_segment_recording(
             start_time, end_time, output_path
         )
         
         self.assertIsNotNone(recording_id)
-        mock_video_writer.assert_called_once()
+        self.assertTrue(stream_handler.wait_for_recording(recording_id))
+        self.mock_video_writer.assert_called_once()
         mock_writer.write.assert_called()
         mock_writer.release.assert_called_once()
     
-    @patch('cv2.VideoWriter')
-    def test_segment_recording_mixed(self, mock_video_writer):
-        """Test recording a mixed segment (past to present)."""
-        mock_writer = Mock()
-        mock_video_writer.return_value = mock_writer
-        mock_writer.isOpened.return_value = True
+    def test_wait_for_recording_forgets_finished_ids(self):
+        """Test finished recordings are dropped once waited on, and unknown ids are rejected."""
+        self._make_writer()
+        stream_handler = self._buffered_handler()
+        
+        now = datetime.now()
+        recording_id = stream_handler.start_segment_recording(
+            now - timedelta(seconds=2), now, os.path.join(self.output_dir, "test_wait.mp4")
+        )
+        
+        self.assertTrue(stream_handler.wait_for_recording(recording_id))
+        self.assertEqual(len(stream_handler._recordings), 0)
+        self.assertEqual(len(stream_handler._finished), 0)
+        with self.assertRaises(ValueError):
+            stream_handler.wait_for_recording(recording_id)
+    
+    def test_snapshot_retries_overwritten_frames(self):
+        """Test frames are chosen again when capture overwrites them before they're copied."""
+        stream_handler = self._buffered_handler()
+        frames_at = FrameRing.frames_at
+        calls = []
+        
+        def frames_at_then_wrap(self_ring, times):
+            indices = frames_at(self_ring, times)
+            calls.append(times)
+            if len(calls) == 1:
+                # Capture laps the whole ring between choosing slots and copying them
+                frame = np.full((48, 64, 3), 255, dtype=np.uint8)
+                for _ in range(self_ring.capacity):
+                    self_ring.append(time.time_ns(), frame)
+            return indices
+        
+        now = datetime.now()
+        with patch.object(FrameRing, 'frames_at', autospec=True,
+                          side_effect=frames_at_then_wrap) as mock_frames_at:
+            frames, _ = stream_handler._snapshot_frames([(now - timedelta(seconds=1), now)], 30)
+        
+        self.assertEqual(mock_frames_at.call_count, 2)
+        # Only frames from after the lap were kept
+        self.assertEqual(frames.min(), 255)
+    
+    def test_segment_recording_before_buffer(self):
+        """Test a window that ended before the oldest buffered frame records nothing."""
+        self._make_writer()
+        stream_handler = self._buffered_handler(seconds=10.0)
         
-        # Start stream to populate buffer
-        self.stream_handler.start_stream()
-        import time
-        time.sleep(0.2)
+        now = datetime.now()
+        recording_id = stream_handler.start_segment_recording(
+            now - timedelta(seconds=30), now - timedelta(seconds=20),
+            os.path.join(self.output_dir, "test_too_old.mp4")
+        )
+        
+        self.assertIsNone(recording_id)
+        self.mock_video_writer.assert_not_called()
+    
+    def test_segment_recording_without_intact_frames(self):
+        """Test recording from a ring whose only frame may be mid-write records nothing."""
+        self._make_writer()
+        stream_handler = StreamHandler(self.mock_cap, buffer_seconds=10)
+        self.addCleanup(stream_handler.stop_stream)
+        # One slot is always the one being written, so its frame is never read
+        stream_handler.frame_buffer = FrameRing(1)
+        stream_handler.frame_buffer.append(time.time_ns(), np.zeros((48, 64, 3), dtype=np.uint8))
+        
+        now = datetime.now()
+        recording_id = stream_handler.start_segment_recording(
+            now - timedelta(seconds=2), now, os.path.join(self.output_dir, "test_one_slot.mp4")
+        )
+        
+        self.assertIsNone(recording_id)
+        self.mock_video_writer.assert_not_called()
+    
+    def test_segment_recording_mixed(self):
+        """Test recording a mixed segment (past to present)."""
+        self._make_writer()
+        stream_handler = self._buffered_handler()
         
         # Record from past to now
         now = datetime.now()
         start_time = now - timedelta(seconds=3)
         end_time = now  # Current time
         
-        output_path = os.path.join(self.temp_dir, "test_mixed.mp4")
-        recording_id = self.stream_handler.start_segment_recording(
+        output_path = os.path.join(self.output_dir, "test_mixed.mp4")
+        recording_id = stream_handler.start_segment_recording(
             start_time, end_time, output_path
         )
         
         self.assertIsNotNone(recording_id)
-        mock_video_writer.assert_called_once()
+        self.mock_video_writer.assert_called_once()
     
     def test_future_end_time_adjustment(self):
         """Test that future end times get adjusted to current time."""
-        with patch('cv2.VideoWriter') as mock_video_writer:
-            mock_writer = Mock()
-            mock_video_writer.return_value = mock_writer
-            mock_writer.isOpened.return_value = True
-            
-            self.stream_handler.start_stream()
-            import time
-            time.sleep(0.1)
-            
-            # Try to record with future end time
-            now = datetime.now()
-            start_time = now - timedelta(seconds=5)
-            end_time = now + timedelta(seconds=10)  # Future
-            
-            output_path = os.path.join(self.temp_dir, "test_future.mp4")
+        self._make_writer()
+        stream_handler = self._buffered_handler()
+        
+        # Try to record with future end time
+        now = datetime.now()
+        start_time = now - timedelta(seconds=5)
+        end_time = now + timedelta(seconds=10)  # Future
+        
+        output_path = os.path.join(self.output_dir, "test_future.mp4")
+        
+        with patch.object(stream_handler, 'logger') as mock_logger:
+            stream_handler.start_segment_recording(
+                start_time, end_time, output_path
+            )
             
-            with patch.object(self.stream_handler, 'logger') as mock_logger:
-                recording_id = self.stream_handler.start_segment_recording(
-                    start_time, end_time, output_path
-                )
-                
-                # Should log a warning about adjusting end time
-                mock_logger.warning.assert_called()
+            # Should log a warning about adjusting end time
+            mock_logger.warning.assert_called()
     
     def test_record_multiple_segments(self):
         """Test recording multiple segments from timestamp list."""
-        with patch('cv2.VideoWriter') as mock_video_writer:
-            mock_writer = Mock()
-            mock_video_writer.return_value = mock_writer
-            mock_writer.isOpened.return_value = True
-            
-            self.stream_handler.start_stream()
-            import time
-            time.sleep(0.2)
-            
-            now = datetime.now()
-            timestamps = [
-                (now - timedelta(seconds=10), now - timedelta(seconds=8)),
-                (now - timedelta(seconds=6), now - timedelta(seconds=4)),
-                (now - timedelta(seconds=2), now)
-            ]
-            
-            recording_ids = self.stream_handler.record_segment_from_timestamps(
-                timestamps, self.temp_dir
-            )
-            
-            self.assertEqual(len(recording_ids), 3)
-            self.assertEqual(mock_video_writer.call_count, 3)
-
+        self._make_writer()
+        stream_handler = self._buffered_handler()
+        
+        now = datetime.now()
+        timestamps = [
+            (now - timedelta(seconds=10), now - timedelta(seconds=8)),
+            (now - timedelta(seconds=6), now - timedelta(seconds=4)),
+            (now - timedelta(seconds=2), now)
+        ]
+        
+        recording_ids = stream_handler.record_segment_from_timestamps(
+            timestamps, self.output_dir
+        )
+        
+        self.assertEqual(len(recording_ids), 3)
+        self.assertEqual(self.mock_video_writer.call_count, 3)
 
 class TestReolinkClient(unittest.TestCase):
     """Test cases for ReolinkClient class."""
     
     def setUp(self):
         """Set up test fixtures."""
+        self.cache_dir = tempfile.mkdtemp()
         self.client = ReolinkClient(
             host="192.168.1.100",
             username="admin", 
             password="password123",
-            port=80
+            port=80,
+            cache_dir=self.cache_dir
         )
+        # Treat every camera port as open; the HTTP calls themselves are mocked per test
+        patcher = patch('socket.create_connection')
+        patcher.start()
+        self.addCleanup(patcher.stop)
+    
+    def tearDown(self):
+        """Clean up the auth endpoint cache."""
+        shutil.rmtree(self.cache_dir, ignore_errors=True)
     
     def test_client_initialization(self):
         """Test ReolinkClient initializes correctly."""
@@ -196,7 +315,7 @@ class TestReolinkClient(unittest.TestCase):
         self.assertEqual(self.client.port, 80)
         self.assertIsNone(self.client.token)
     
-    @patch('requests.post')
+    @patch('requests.Session.post')
     def test_authentication_success(self, mock_post):
         """Test successful authentication."""
         # Mock successful authentication response
@@ -214,7 +333,55 @@ class TestReolinkClient(unittest.TestCase):
         self.assertEqual(self.client.token, "test_token_123")
         mock_post.assert_called_once()
     
-    @patch('requests.post')
+    @patch('cv2.VideoCapture')
+    @patch('requests.Session.get')
+    @patch('requests.Session.post')
+    def test_authentication_tries_rtsp_last(self, mock_post, mock_get, mock_video_capture):
+        """Test RTSP is only probed once every HTTP method has failed."""
+        mock_response = Mock()
+        mock_response.status_code = 200
+        mock_response.json.return_value = [{
+            "code": 0,
+            "value": {"Token": {"name": "test_token_123"}}
+        }]
+        mock_post.return_value = mock_response
+        mock_get.side_effect = Exception("Network error")
+        
+        self.assertTrue(self.client.authenticate())
+        self.assertEqual(self.client.auth_method, "api")
+        mock_video_capture.assert_not_called()
+        
+        mock_post.side_effect = Exception("Network error")
+        mock_video_capture.return_value.isOpened.return_value = False
+        client = ReolinkClient("192.168.1.100", "admin", "password123", cache_dir=None)
+        self.assertFalse(client.authenticate())
+        mock_video_capture.assert_called()
+    
+    @patch('requests.Session.get')
+    @patch('requests.Session.post')
+    def test_authentication_uses_cached_endpoint(self, mock_post, mock_get):
+        """Test reconnecting retries the previously successful method alone."""
+        mock_response = Mock()
+        mock_response.status_code = 200
+        mock_response.json.return_value = [{
+            "code": 0,
+            "value": {"Token": {"name": "test_token_123"}}
+        }]
+        mock_post.return_value = mock_response
+        mock_get.side_effect = Exception("Network error")
+        
+        self.assertTrue(self.client.authenticate())
+        mock_get.reset_mock()
+        
+        client = ReolinkClient("192.168.1.100", "admin", "password123", cache_dir=self.cache_dir)
+        self.assertTrue(client.authenticate())
+        self.assertEqual(client.auth_method, "api")
+        self.assertEqual(client.token, "test_token_123")
+        mock_get.assert_not_called()
+        # A stale cached endpoint mustn't cost the full request timeout
+        self.assertEqual(mock_post.call_args.kwargs["timeout"], ReolinkClient.PROBE_TIMEOUT)
+    
+    @patch('requests.Session.post')
     def test_authentication_failure(self, mock_post):
         """Test failed authentication."""
         # Mock failed authentication response
@@ -228,7 +395,7 @@ class TestReolinkClient(unittest.TestCase):
         self.assertFalse(result)
         self.assertIsNone(self.client.token)
     
-    @patch('requests.post')
+    @patch('requests.Session.post')
     def test_authentication_network_error(self, mock_post):
         """Test authentication with network error."""
         mock_post.side_effect = Exception("Network error")
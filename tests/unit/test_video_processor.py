@@ -0,0 +1,119 @@
+"""
+Unit tests for video processing components.
+
+Tests motion detection and the basic frame operations of
+VideoProcessor on synthetic frames.
+"""
+
+import unittest
+from unittest.mock import patch
+import numpy as np
+import tempfile
+import os
+
+from processing.video_processor import VideoProcessor
+
+
+_TMP = None
+
+
+def setUpModule():
+    """Create one output directory for every test in the module."""
+    global _TMP
+    _TMP = tempfile.TemporaryDirectory()
+
+
+def tearDownModule():
+    """Remove the module's output directory."""
+    _TMP.cleanup()
+
+
+class TestVideoProcessor(unittest.TestCase):
+    """Test cases for VideoProcessor class."""
+
+    # Motion tests don't check shapes, and MOG2 is memory-bound, so they use small frames
+    _MOTION_SHAPE = (48, 64, 3)
+
+    @classmethod
+    def setUpClass(cls):
+        """Build the read-only test frames once for the whole class."""
+        cls._TEST_FRAME = np.random.default_rng(0).integers(0, 255, (480, 640, 3), dtype=np.uint8)
+        cls._STATIC_FRAME = np.zeros(cls._MOTION_SHAPE, dtype=np.uint8)
+        cls._MOTION_FRAME = np.zeros(cls._MOTION_SHAPE, dtype=np.uint8)
+        cls._MOTION_FRAME[10:20, 10:20] = 255
+
+    def setUp(self):
+        """Set up test fixtures before each test method."""
+        self.processor = VideoProcessor()
+        # No test writes to these, so they are shared rather than copied
+        self.test_frame = self._TEST_FRAME
+        self.static_frame = self._STATIC_FRAME
+
+        # The save_frame tests use their own file names under the module's directory
+        self.temp_dir = _TMP.name
+
+    def test_processor_initialization(self):
+        """Test VideoProcessor initializes correctly."""
+        self.assertIsNotNone(self.processor.background_subtractor)
+        self.assertEqual(self.processor.motion_scale, 4)
+
+    def test_motion_detection_no_motion(self):
+        """Test that a static scene reports no motion."""
+        for _ in range(10):
+            self.processor.detect_motion(self.static_frame)
+
+        self.assertFalse(self.processor.detect_motion(self.static_frame))
+
+    def test_motion_detection_with_motion(self):
+        """Test that a large change against a learned background is detected."""
+        for _ in range(10):
+            self.processor.detect_motion(self.static_frame)
+
+        self.assertTrue(self.processor.detect_motion(self._MOTION_FRAME, threshold=50))
+
+    def test_resize_frame(self):
+        """Test resizing a frame."""
+        resized = self.processor.resize_frame(self.test_frame, 320, 240)
+        self.assertEqual(resized.shape, (240, 320, 3))
+
+    def test_apply_filters_none(self):
+        """Test that no filters returns the input frame."""
+        filtered = self.processor.apply_filters(self.test_frame)
+        self.assertIs(filtered, self.test_frame)
+
+    def test_apply_filters_blur(self):
+        """Test applying the blur filter."""
+        filtered = self.processor.apply_filters(self.test_frame, blur=True)
+        self.assertEqual(filtered.shape, self.test_frame.shape)
+        self.assertFalse(np.array_equal(filtered, self.test_frame))
+
+    def test_apply_filters_grayscale(self):
+        """Test that grayscale output keeps three identical channels."""
+        filtered = self.processor.apply_filters(self.test_frame, grayscale=True)
+        self.assertEqual(filtered.shape, self.test_frame.shape)
+        # One broadcast comparison of every channel against the first
+        self.assertTrue(np.all(filtered[..., :1] == filtered[..., 1:]))
+
+    @patch('cv2.imwrite', return_value=True)
+    def test_save_frame_success(self, mock_imwrite):
+        """Test saving a frame hands it to cv2.imwrite."""
+        output_path = os.path.join(self.temp_dir, "frame.jpg")
+        self.assertTrue(self.processor.save_frame(self.test_frame, output_path))
+        mock_imwrite.assert_called_once_with(output_path, self.test_frame)
+
+    def test_save_frame_invalid_path(self):
+        """Test saving a frame to a directory that doesn't exist."""
+        # Left unmocked: OpenCV fails to open the file before encoding anything
+        output_path = os.path.join(self.temp_dir, "missing", "frame.jpg")
+        self.assertFalse(self.processor.save_frame(self.test_frame, output_path))
+
+    def test_get_frame_info(self):
+        """Test frame information reporting."""
+        info = self.processor.get_frame_info(self.test_frame)
+        self.assertEqual(info['shape'], (480, 640, 3))
+        self.assertEqual(info['dtype'], 'uint8')
+        self.assertEqual(info['channels'], 3)
+
+
+if __name__ == '__main__':
+    unittest.main()